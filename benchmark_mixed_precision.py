@@ -0,0 +1,138 @@
+"""
+Compares adapter MLM training throughput and peak memory across the --mixed_precision modes of run_mlm.py. Every mode
+runs in a fresh process on random batches of the same shape, so peak memory is measured per mode. Peak memory is
+reported above a baseline taken once the model is loaded, so it covers what the training steps add: activations,
+gradients and optimizer state.
+
+    python benchmark_mixed_precision.py --model_name_or_path bert-base-uncased --modes no bf16
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+
+import torch
+from transformers import AutoModelForMaskedLM, AutoTokenizer
+from transformers.adapters.configuration import AdapterConfig
+
+from run_mlm import FastMLMCollator, autocast_context, build_optimizer, make_accelerator
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark mixed precision modes for adapter MLM training")
+    parser.add_argument("--model_name_or_path", type=str, default="bert-base-uncased")
+    parser.add_argument("--adapter_config", type=str, default="houlsby")
+    parser.add_argument("--non_linearity", type=str, default="gelu")
+    parser.add_argument("--reduction_factor", type=int, default=12)
+    parser.add_argument("--modes", nargs="+", default=["no", "fp16", "bf16"], choices=["no", "fp16", "bf16"])
+    parser.add_argument("--batch_size", type=int, default=32)
+    parser.add_argument("--seq_length", type=int, default=32, help="Tokens per example, the walk lines are short.")
+    parser.add_argument("--steps", type=int, default=20, help="Timed optimizer steps per mode.")
+    parser.add_argument("--warmup_steps", type=int, default=3)
+    parser.add_argument("--learning_rate", type=float, default=1e-4)
+    parser.add_argument("--weight_decay", type=float, default=0.01)
+    parser.add_argument("--optimizer_impl", type=str, default="transformers")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--single_mode", type=str, default=None, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def peak_memory(device):
+    """
+    Peak memory of the process so far: allocated CUDA memory since the last reset of the peak stats, or on CPU the
+    maximum resident set size, which also counts loading the model and tokenizer.
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device)
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_mode(args, mode):
+    """
+    Trains the adapter for warmup_steps plus steps on random batches and returns the timing of the last steps and the
+    peak memory of all steps above what the process held before them.
+    """
+    torch.manual_seed(args.seed)
+    accelerator = make_accelerator(mode)
+    tokenizer = AutoTokenizer.from_pretrained(args.model_name_or_path)
+    model = AutoModelForMaskedLM.from_pretrained(args.model_name_or_path)
+    adapter_config = AdapterConfig.load(
+        args.adapter_config, non_linearity=args.non_linearity, reduction_factor=args.reduction_factor
+    )
+    model.add_adapter("benchmark", config=adapter_config)
+    model.train_adapter(["benchmark"])
+    model.set_active_adapters("benchmark")
+    optimizer = build_optimizer(model, args)
+    model, optimizer = accelerator.prepare(model, optimizer)
+    model.train()
+
+    collator = FastMLMCollator(tokenizer)
+    body = args.seq_length - tokenizer.num_special_tokens_to_add()
+    examples = [
+        {"input_ids": tokenizer.build_inputs_with_special_tokens(ids.tolist())}
+        for ids in torch.randint(len(tokenizer), (args.batch_size, body))
+    ]
+
+    if accelerator.device.type == "cuda":
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        baseline = torch.cuda.memory_allocated(accelerator.device)
+    else:
+        # ru_maxrss only grows, the steps show up as growth past the peak of loading
+        baseline = peak_memory(accelerator.device)
+
+    for step in range(args.warmup_steps + args.steps):
+        if step == args.warmup_steps:
+            if accelerator.device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.time()
+        batch = {k: v.to(accelerator.device) for k, v in collator(examples).items()}
+        with autocast_context(accelerator, mode):
+            loss = model(**batch).loss
+        accelerator.backward(loss)
+        optimizer.step()
+        optimizer.zero_grad()
+    if accelerator.device.type == "cuda":
+        torch.cuda.synchronize()
+    elapsed = time.time() - start
+
+    return {
+        "mode": mode,
+        "device": accelerator.device.type,
+        "tokens_per_sec": args.steps * args.batch_size * args.seq_length / elapsed,
+        "peak_memory_mb": (peak_memory(accelerator.device) - baseline) / 2 ** 20,
+        "final_loss": float(loss),
+    }
+
+
+def main():
+    args = parse_args()
+    if args.single_mode is not None:
+        print(json.dumps(run_mode(args, args.single_mode)))
+        return
+
+    results = []
+    for mode in args.modes:
+        command = [sys.executable, __file__, "--single_mode", mode]
+        for name, value in vars(args).items():
+            if name not in ("modes", "single_mode"):
+                command += [f"--{name}", str(value)]
+        done = subprocess.run(command, stdout=subprocess.PIPE, universal_newlines=True)
+        if done.returncode != 0:
+            print(f"{mode}: failed with exit code {done.returncode}")
+            continue
+        results.append(json.loads(done.stdout.strip().splitlines()[-1]))
+
+    print(f"{'mode':<6} {'device':<6} {'tokens/sec':>12} {'peak MB':>10} {'loss':>8}")
+    for result in results:
+        print(
+            f"{result['mode']:<6} {result['device']:<6} {result['tokens_per_sec']:>12.0f} "
+            f"{result['peak_memory_mb']:>10.0f} {result['final_loss']:>8.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
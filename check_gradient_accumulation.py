@@ -0,0 +1,103 @@
+"""
+Checks that gradient accumulation in run_mlm.py makes the same update as training without it. A tiny linear model
+takes one optimizer step after an accumulation window of micro-batches, run through accelerate and the training
+loop's accumulation_windows and accumulate_batch, and one optimizer step on the whole window as a single batch. The
+parameters have to agree within --rtol and --atol, for SGD and AdamW, and for full windows as well as the short
+window that ends an epoch whose batches gradient_accumulation_steps does not divide.
+
+    python check_gradient_accumulation.py
+"""
+import argparse
+import types
+
+import torch
+from accelerate import Accelerator
+from torch import nn
+
+from run_mlm import accumulate_batch, accumulation_windows
+
+# (micro-batches in the epoch, gradient_accumulation_steps), the last window is checked, it is short for (7, 3) and (2, 4)
+CASES = [(3, 3), (7, 3), (4, 4), (2, 4), (1, 1)]
+
+
+class LinearRegression(nn.Module):
+    def __init__(self, features):
+        super().__init__()
+        self.linear = nn.Linear(features, 1)
+
+    def forward(self, inputs, targets):
+        loss = nn.functional.mse_loss(self.linear(inputs).squeeze(-1), targets)
+        return types.SimpleNamespace(loss=loss)
+
+
+def make_optimizer(name, model):
+    if name == "sgd":
+        return torch.optim.SGD(model.parameters(), lr=0.1)
+    return torch.optim.AdamW(model.parameters(), lr=0.01, eps=1e-6)
+
+
+def step_after_window(batches, gradient_accumulation_steps, optimizer_name, seed):
+    """
+    Runs the micro-batches of the last accumulation window of an epoch of batches the way run_mlm.main does, takes
+    the optimizer step it ends with and returns the parameters after it.
+    """
+    torch.manual_seed(seed)
+    accelerator = Accelerator(cpu=True)
+    model = LinearRegression(batches[0]["inputs"].shape[1])
+    model, optimizer = accelerator.prepare(model, make_optimizer(optimizer_name, model))
+    windows = accumulation_windows(len(batches), gradient_accumulation_steps)
+    if not windows[-1][0]:
+        raise AssertionError("the last batch of an epoch has to end its accumulation window")
+    window_start = len(batches) - windows[-1][1]
+    for (sync_gradients, window), batch in list(zip(windows, batches))[window_start:]:
+        accumulate_batch(accelerator, model, batch, window, sync_gradients)
+    optimizer.step()
+    return [p.detach().clone() for p in model.parameters()], windows[-1][1]
+
+
+def check(num_batches, gradient_accumulation_steps, optimizer_name, args):
+    """
+    Compares the step after the last accumulation window of num_batches micro-batches with one step on those
+    micro-batches concatenated. Returns the window size and the largest parameter difference.
+    """
+    generator = torch.Generator().manual_seed(args.seed)
+    micro_batches = [
+        {
+            "inputs": torch.randn(args.batch_size, 8, generator=generator),
+            "targets": torch.randn(args.batch_size, generator=generator),
+        }
+        for _ in range(num_batches)
+    ]
+    accumulated, window = step_after_window(micro_batches, gradient_accumulation_steps, optimizer_name, args.seed)
+    whole_batch = {key: torch.cat([batch[key] for batch in micro_batches[-window:]]) for key in ("inputs", "targets")}
+    whole, _ = step_after_window([whole_batch], 1, optimizer_name, args.seed)
+
+    difference = max(float((a - w).abs().max()) for a, w in zip(accumulated, whole))
+    for a, w in zip(accumulated, whole):
+        if not torch.allclose(a, w, rtol=args.rtol, atol=args.atol):
+            raise AssertionError(
+                f"{optimizer_name}, gradient_accumulation_steps={gradient_accumulation_steps}, window of {window}: "
+                f"parameters differ by {difference:.2e}"
+            )
+    return window, difference
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check gradient accumulation against whole-batch training")
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--rtol", type=float, default=1e-5)
+    parser.add_argument("--atol", type=float, default=1e-6)
+    args = parser.parse_args()
+
+    for optimizer_name in ("sgd", "adamw"):
+        for num_batches, gradient_accumulation_steps in CASES:
+            window, difference = check(num_batches, gradient_accumulation_steps, optimizer_name, args)
+            print(
+                f"ok: {optimizer_name:<5} gradient_accumulation_steps={gradient_accumulation_steps}, window of "
+                f"{window}: max difference {difference:.1e}"
+            )
+
+
+if __name__ == "__main__":
+    main()
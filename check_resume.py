@@ -0,0 +1,127 @@
+"""
+Checks that resuming from a checkpoint in run_mlm.py trains on the same next batch as the interrupted run. An epoch
+of random sequences is loaded, shuffled and masked the way run_mlm.main does, with a random draw standing in for
+each training step. At a checkpoint step the data generator and RNG states are kept like save_checkpoint keeps them.
+A fresh loader then resumes from them with skip_trained_batches. The next batch, its masking and the training RNG
+have to match the interrupted run exactly, with and without DataLoader workers, and with and without a DataLoader
+that collates one batch ahead, as recent accelerate versions do.
+
+    python check_resume.py
+"""
+import argparse
+
+import torch
+from torch.utils.data import DataLoader
+
+from run_mlm import (
+    FastMLMCollator,
+    SeededCollator,
+    epoch_collate_seed,
+    epoch_generator_seed,
+    rng_state,
+    skip_trained_batches,
+)
+
+
+class Tokenizer:
+    """
+    The part of a BERT tokenizer FastMLMCollator reads.
+    """
+
+    pad_token_id, unk_token_id, cls_token_id, sep_token_id, mask_token_id = range(5)
+    bos_token_id = eos_token_id = None
+
+    def __len__(self):
+        return 100
+
+
+class Lookahead:
+    """
+    Iterates a DataLoader one batch ahead, like accelerate's DataLoaderShard, which fetches the next batch before
+    yielding the current one.
+    """
+
+    def __init__(self, dataloader):
+        self.dataloader = dataloader
+
+    def __iter__(self):
+        iterator = iter(self.dataloader)
+        current = next(iterator, None)
+        while current is not None:
+            following = next(iterator, None)
+            yield current
+            current = following
+
+
+def make_loader(examples, args, num_workers, lookahead):
+    generator = torch.Generator()
+    collator = SeededCollator(FastMLMCollator(Tokenizer()))
+    dataloader = DataLoader(
+        examples, shuffle=True, batch_size=args.batch_size, collate_fn=collator, generator=generator,
+        num_workers=num_workers,
+    )
+    return (Lookahead(dataloader) if lookahead else dataloader), generator, collator
+
+
+def start_epoch(generator, collator, args):
+    generator.manual_seed(epoch_generator_seed(args.seed, args.epoch))
+    collator.manual_seed(epoch_collate_seed(args.seed, args.epoch))
+    return generator.get_state()
+
+
+def check(examples, args, num_workers, lookahead):
+    """
+    Returns the step after the checkpoint whose batch was compared.
+    """
+    torch.manual_seed(args.seed)
+    loader, generator, collator = make_loader(examples, args, num_workers, lookahead)
+    epoch_generator_state = start_epoch(generator, collator, args)
+    rng, expected_batch, expected_draw = None, None, None
+    for step, batch in enumerate(loader):
+        # Training draws from the global RNG, for example for dropout
+        draw = torch.rand(4)
+        if step == args.checkpoint_step:
+            rng = dict(rng_state(), epoch_generator=epoch_generator_state)
+        elif step == args.checkpoint_step + 1:
+            expected_batch, expected_draw = batch, draw
+            break
+
+    # A new process resuming from the checkpoint, its global RNG is elsewhere
+    torch.manual_seed(args.seed + 1)
+    loader, generator, collator = make_loader(examples, args, num_workers, lookahead)
+    start_epoch(generator, collator, args)
+    generator.set_state(rng["epoch_generator"])
+    step, batch = next(iter(skip_trained_batches(loader, args.checkpoint_step + 1, rng)))
+    draw = torch.rand(4)
+
+    setting = f"num_workers={num_workers}, lookahead={lookahead}"
+    if step != args.checkpoint_step + 1:
+        raise AssertionError(f"{setting}: resumed at step {step}, not {args.checkpoint_step + 1}")
+    for key in expected_batch:
+        if not torch.equal(batch[key], expected_batch[key]):
+            raise AssertionError(f"{setting}: the {key} of the first batch after resuming differ")
+    if not torch.equal(draw, expected_draw):
+        raise AssertionError(f"{setting}: the training RNG differs after resuming")
+    return step
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Check that resuming trains on the same next batch")
+    parser.add_argument("--examples", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--checkpoint_step", type=int, default=5)
+    parser.add_argument("--epoch", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generator = torch.Generator().manual_seed(args.seed)
+    lengths = torch.randint(3, 12, (args.examples,), generator=generator).tolist()
+    examples = [{"input_ids": [2] + torch.randint(5, 100, (n,), generator=generator).tolist() + [3]} for n in lengths]
+    for num_workers in (0, 2):
+        for lookahead in (False, True):
+            step = check(examples, args, num_workers, lookahead)
+            print(f"ok: num_workers={num_workers}, lookahead={lookahead}, same batch {step} after resuming")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,13 @@
-import pickle
 import codecs
+import gzip
 from tqdm import tqdm
 import os
-from concurrent.futures import ProcessPoolExecutor, as_completed
+import random
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import walk_store
+from token_store import CachedLineTokenizer, TokenStoreWriter
 
 # Modified from https://github.com/Wluper/Retrograph/blob/master/randomwalks_utility/create_corpora_from_random_walks.py
 
@@ -26,77 +31,217 @@ LAMA_relations = [
   "usedFor"
 ]
 
-def load_walks(path="../data/concept_net/randomwalks/random_walk_1.0_1.0_2_10.p"):
-  return pickle.load(open(path, "rb"))
+def load_walks(path="../data/concept_net/randomwalks/random_walk_1.0_1.0_2_10.walks"):
+  '''
+  Opens a walk store without deserializing it. Older pickled walk files still
+  load, convert_pickled_walks turns them into a walk store.
+  '''
+  return walk_store.load_walks(path)
 
 
 def create_relationship_token(text):
   # here, I've changed something
   return text #"<" + "".join(text.split(" ")) + ">"
 
+def process_walk(walk):
+  '''
+  Turns one walk into its corpus text, one "node relation node." sentence per
+  line followed by an empty line that ends the document.
+  '''
+  parts = []
+  previous_token = ""
+  for i, token in enumerate(walk):
+    # every first token is a node and every second is a relationship
+    # we don't need to capitalize anything as we are anyways working with the uncased BERT
+    if (i % 2 == 0 and previous_token != "" and i != 0 and i != 2) or (i == 3 and previous_token != ""):
+      # we have reached the end of a valid sentence sequence, so we put a period
+      if i == 3:
+        # replace the space after the first sentence's last node
+        parts[-1] = parts[-1][:-1]
+        parts.append(".\n")
+      else:
+        parts.append(token + ".\n")
+      if i != len(walk) - 1 and i == 3:
+        # if the walk is not finished yet, we duplicate the token
+        parts.append(previous_token + " " + create_relationship_token(token) + " ")
+      elif i != len(walk) - 1:
+        # if the walk is not finished yet, we duplicate the token
+        parts.append(token + " ")
+      else:
+        # otherwise we can put a new line to mark the end of a document
+        parts.append("\n\n")
+    elif i % 2 == 0:
+      parts.append(token + " ")
+    elif i % 1 == 0:
+      parts.append(create_relationship_token(token) + " ")
+    previous_token = token
+  return "".join(parts)
+
 def process_walks(walks):
-  print(walks[1])
-  text = ""
-  for walk in walks:
-    previous_token = ""
-    for i, token in enumerate(walk):
-      # every first token is a node and every second is a relationship
-      # we don't need to capitalize anything as we are anyways working with the uncased BERT
-      if (i % 2 == 0 and previous_token != "" and i != 0 and i != 2) or (i == 3 and previous_token != ""):
-        # we have reached the end of a valid sentence sequence, so we put a period
-        if i == 3:
-          text = text[:-1] + ".\n"
-        else:
-          text = text + token + ".\n"
-        if i != len(walk) - 1 and i == 3:
-          # if the walk is not finished yet, we duplicate the token
-          text = text + previous_token + " " + create_relationship_token(token) + " "
-        elif i != len(walk) - 1:
-          # if the walk is not finished yet, we duplicate the token
-          text = text + token + " "
-        else:
-          # otherwise we can put a new line to mark the end of a document
-          text = text + "\n\n"
-      elif i % 2 == 0:
-        text = text + token + " "
-      elif i % 1 == 0:
-        text = text + create_relationship_token(token) + " "
-      previous_token = token
-  return text
+  return "".join([process_walk(walk) for walk in walks])
+
+# Line tokenizers of this process, keyed by tokenizer name or path
+_line_tokenizers = {}
+
+def line_tokenizer(tokenizer_name):
+  if tokenizer_name not in _line_tokenizers:
+    from transformers import AutoTokenizer
+    _line_tokenizers[tokenizer_name] = CachedLineTokenizer(AutoTokenizer.from_pretrained(tokenizer_name))
+  return _line_tokenizers[tokenizer_name]
+
+def tokenize_corpus_text(text, tokenizer_name):
+  '''
+  Tokenizes the complete non-empty lines of a chunk of corpus text, without
+  special tokens. The first and the last line may continue lines of the
+  neighbouring chunks, so they are returned as text. Returns (first_line, ids,
+  bounds, last_line), where ids is None if text has no line break at all.
+  '''
+  lines = text.split("\n")
+  if len(lines) == 1:
+    return lines[0], None, None, None
+  encoder = line_tokenizer(tokenizer_name)
+  sequences = [encoder.encode(line) for line in lines[1:-1] if line and not line.isspace()]
+  bounds = np.zeros(len(sequences) + 1, dtype=np.int64)
+  np.cumsum([len(ids) for ids in sequences], out=bounds[1:])
+  ids = np.fromiter((i for ids in sequences for i in ids), dtype=np.int64, count=bounds[-1])
+  return lines[0], ids, bounds, lines[-1]
+
+def render_walks(walks, tokenizer_name=None):
+  '''
+  Turns walks into corpus text, or into tokenized lines with tokenize_corpus_text
+  if tokenizer_name is given.
+  '''
+  text = process_walks(walks)
+  return text if tokenizer_name is None else tokenize_corpus_text(text, tokenizer_name)
+
+class TokenCorpusWriter():
+  '''
+  Writes the results of tokenize_corpus_text to a token store (see
+  token_store.py), in order, joining the lines that span two chunks just as they
+  are joined in the text corpus. The store holds one sequence per non-empty line
+  of the text corpus, which is what run_mlm.py trains on with --line_by_line.
+  '''
+  def __init__(self, output_path, tokenizer_name, meta=None):
+    self.encoder = line_tokenizer(tokenizer_name)
+    meta = dict(meta or {}, tokenizer=tokenizer_name, line_by_line=True, special_tokens=False)
+    self.store = TokenStoreWriter(output_path, len(self.encoder.tokenizer), meta)
+    self.carry = ""
+
+  def write(self, result):
+    first_line, ids, bounds, last_line = result
+    if ids is None:
+      self.carry += first_line
+      return
+    self._write_line(self.carry + first_line)
+    self.store.append(ids, bounds)
+    self.carry = last_line
+
+  def _write_line(self, line):
+    if line and not line.isspace():
+      self.store.append_sequences([self.encoder.encode(line)])
+
+  def close(self):
+    self._write_line(self.carry)
+    self.store.close()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
 
 def chunks(lst, n):
   """Yield successive n-sized chunks from lst."""
   for i in range(0, len(lst), n):
     yield lst[i:i + n]
 
-def generate_corpus_from_walks(walks, output_path):
+def open_corpus(output_path, compress=False):
+  '''
+  Opens the corpus file for writing, gzip compressed if compress is set or the
+  path ends in .gz.
+  '''
+  if os.path.dirname(output_path):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+  if compress or output_path.endswith(".gz"):
+    return gzip.open(output_path, "wt", encoding="utf8", newline="")
+  return codecs.open(output_path, "w", "utf8")
+
+def write_corpus(walks, output_path, splits=1000, compress=False):
+  '''
+  Writes the corpus of walks in a single process, one chunk of splits walks at
+  a time, so only one chunk of text is in memory.
+  '''
+  with open_corpus(output_path, compress) as out:
+    for ws in tqdm(chunks(walks, splits)):
+      out.write(process_walks(ws))
+
+def adaptive_splits(num_walks, workers, min_splits=100, max_splits=20000):
+  '''
+  Picks a chunk size that gives every worker about eight chunks, which keeps the
+  pool busy without making the per-chunk overhead dominate.
+  '''
+  return max(min_splits, min(max_splits, -(-num_walks // (8 * workers))))
+
+# Walk stores opened by this worker process, keyed by path
+_open_stores = {}
+
+def process_store_slice(path, start, stop, tokenizer_name=None):
+  '''
+  Processes walks start to stop of the walk store at path, which the worker
+  opens itself instead of receiving the walks pickled through the executor.
+  '''
+  if path not in _open_stores:
+    _open_stores[path] = walk_store.WalkStore(path)
+  return render_walks(_open_stores[path][start:stop], tokenizer_name)
+
+def generate_corpus_from_walks(walks, output_path, workers=10, splits=None, shuffle_seed=None, compress=False,
+                               tokenizer_name=None, verify_lines=1000):
+  '''
+  Writes the corpus of walks with a pool of worker processes. Chunks of splits
+  walks (chosen by adaptive_splits if None) are written in input order, or in an
+  order shuffled with shuffle_seed, so the output is the same on every run.
+
+  With a tokenizer_name, output_path becomes a token store holding the token ids
+  of every line of the text corpus instead, ready for run_mlm.py's
+  --train_token_store. Each distinct word is tokenized once, and the first
+  verify_lines lines are checked against tokenizing them whole.
+  '''
   # how do we actually want to generate the corpus?
   # one option is to always dublicate the node in the middle..
   # also Goran says that we want to keep the relations as separate tokens in the vocab. I do not necessarily agree with this, but we try.
   # What is one document? Is is always one walk? Maybe yes...
-  text = ""
   print('size of walks', len(walks))
   print('processing RWs...')
 
-  workers = 10
-  splits = 1000
-  text = ""
+  if splits is None:
+    splits = adaptive_splits(len(walks), workers)
+  ranges = [(start, min(start + splits, len(walks))) for start in range(0, len(walks), splits)]
+  if shuffle_seed is not None:
+    random.Random(shuffle_seed).shuffle(ranges)
+  # at most this many chunks are queued or held by the workers at any time
+  max_pending = 2 * workers
+
+  def submit(executor, start, stop):
+    if isinstance(walks, walk_store.WalkStore):
+      return executor.submit(process_store_slice, walks.path, start, stop, tokenizer_name)
+    return executor.submit(render_walks, walks[start:stop], tokenizer_name)
 
-  with ProcessPoolExecutor(max_workers=workers) as executor:
-    futures = {}
-    for i, ws in enumerate(chunks(walks, splits)):
-        job = executor.submit(process_walks, ws)
-        futures[job] = i
+  if tokenizer_name is None:
+    out = open_corpus(output_path, compress)
+  else:
+    sample = [line for line in process_walks(walks[:verify_lines]).split("\n") if line and not line.isspace()]
+    line_tokenizer(tokenizer_name).verify(sample[:verify_lines])
+    meta = {"walks": walks.path if isinstance(walks, walk_store.WalkStore) else None, "shuffle_seed": shuffle_seed}
+    out = TokenCorpusWriter(output_path, tokenizer_name, meta)
 
-    for job in tqdm(as_completed(futures)):
-        t = job.result()
-        text += t
-        r = futures[job]
-        del futures[job]
- 
-  os.makedirs(os.path.dirname(output_path), exist_ok=True)
-  with codecs.open(output_path, "w", "utf8") as out:
-    out.write(text)
+  with ProcessPoolExecutor(max_workers=workers) as executor, out:
+    pending = deque()
+    for start, stop in tqdm(ranges):
+      if len(pending) >= max_pending:
+        out.write(pending.popleft().result())
+      pending.append(submit(executor, start, stop))
+    while pending:
+      out.write(pending.popleft().result())
 
 
 def main():
@@ -105,8 +250,10 @@ def main():
   in_prefix = "random_walk_"
   in_suffix = "1.0_1.0_2_15"
 
-  walks = load_walks(pickled_root + in_prefix + in_suffix + ".p")
+  walks = load_walks(pickled_root + in_prefix + in_suffix + ".walks")
   generate_corpus_from_walks(walks, output_path=output + "corpus_complete.txt")
+  # Pretokenized for run_mlm.py --train_token_store instead of text:
+  #generate_corpus_from_walks(walks, output_path=output + "corpus_complete.tokens", tokenizer_name="bert-base-uncased")
 
 
 if __name__=="__main__":
@@ -0,0 +1,311 @@
+import argparse
+import codecs
+import json
+import os
+import shutil
+import numpy as np
+from tqdm import tqdm
+
+from preprocess_cn import LAMA_relations, LAMA_dict, default_dict, read_assertions
+from random_walks import CSRGraph, Graph, walk_pool, worker_graph
+from create_corpora_from_random_walks import open_corpus, process_walk
+from walk_store import WalkStoreWriter
+from walk_scheduler import STRATEGIES, schedule_start_nodes
+from stage_cache import StageCache
+
+# Runs the whole ConceptNet pipeline of preprocess_cn.py, random_walks.py and
+# create_corpora_from_random_walks.py in one process. Walks are turned into
+# corpus text as soon as they are sampled and go straight into the train and
+# validation files that run_mlm.py reads. The assertions file and the walk store
+# are only written when asked for.
+
+
+def _walk_task(task):
+  '''
+  Walks once from every start node of the task and renders the walks as corpus
+  text. Each walk is one document and goes to the validation text with
+  probability validation_fraction. first_relations, if not None, fixes the
+  relation of every walk's first hop. Returns the train text, the validation text,
+  the walks as (tokens, bounds) if keep_ids is set, and the number of walks,
+  of walks that never left their start node and of hops per relation id.
+  '''
+  start_nodes, walk_length, seed, validation_fraction, keep_ids, first_relations = task
+  graph = worker_graph()
+  rng = np.random.default_rng(seed)
+  tokens, bounds = graph.walk_batch(start_nodes, walk_length, rng, first_relations=first_relations)
+  is_validation = rng.random(len(start_nodes)) < validation_fraction
+  train, validation = [], []
+  for i in range(len(start_nodes)):
+    text = process_walk(graph.decode_walk(tokens[bounds[i]:bounds[i + 1]].tolist()))
+    (validation if is_validation[i] else train).append(text)
+  lengths = np.diff(bounds)
+  positions = np.arange(len(tokens)) - np.repeat(bounds[:-1], lengths)
+  hops = np.bincount(tokens[positions % 2 == 1], minlength=len(graph.G.relation_names))
+  stats = len(start_nodes), int((lengths == 1).sum()), hops
+  return "".join(train), "".join(validation), (tokens, bounds) if keep_ids else None, stats
+
+
+def iter_walk_tasks(graph, num_walks, walk_length, seed, batch_size, validation_fraction, keep_ids, start_nodes=None,
+                    first_relations=None):
+  '''
+  Splits every walk iteration into tasks of batch_size shuffled start nodes, or
+  the scheduled start_nodes and their first_relations into tasks of batch_size
+  if given. Each task has its own seed spawned from seed, so the corpus does not
+  depend on the number of workers.
+  '''
+  G = graph.G
+  seed_sequence = np.random.SeedSequence(seed)
+  shuffle_rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+  if start_nodes is not None:
+    for first in range(0, len(start_nodes), batch_size):
+      relations = None if first_relations is None else first_relations[first:first + batch_size]
+      yield (start_nodes[first:first + batch_size], walk_length, seed_sequence.spawn(1)[0], validation_fraction,
+             keep_ids, relations)
+    return
+  for walk_iter in range(num_walks):
+    nodes = shuffle_rng.permutation(G.node_order)
+    for first in range(0, len(nodes), batch_size):
+      yield nodes[first:first + batch_size], walk_length, seed_sequence.spawn(1)[0], validation_fraction, keep_ids, None
+
+
+def build_graph(relations, relations_dir, save_assertions=None):
+  '''
+  Reads the ConceptNet relation files of relations from relations_dir into a
+  CSRGraph, optionally keeping the assertions TSV at save_assertions.
+  '''
+  relation_dict = dict(default_dict, **LAMA_dict)
+  counts = {}
+  assertions = read_assertions(relation_paths(relations, relations_dir), relation_dict, counts)
+  if save_assertions:
+    assertions = list(assertions)
+    if os.path.dirname(save_assertions):
+      os.makedirs(os.path.dirname(save_assertions), exist_ok=True)
+    with codecs.open(save_assertions, "w", "utf8") as out:
+      for assertion in assertions:
+        out.write(assertion[0] + "\t" + assertion[1] + "\t" + assertion[2] + "\n")
+  csr_G = CSRGraph.from_triples(assertions)
+  print(counts)
+  print("%d nodes and %d edges in the graph" % (csr_G.number_of_nodes(), csr_G.number_of_edges()))
+  return csr_G
+
+
+def relation_paths(relations, relations_dir):
+  return [f"{relations_dir}/cn_{relation}.txt" for relation in relations]
+
+
+def write_corpus(graph, train_file, validation_file, num_walks, walk_length, workers, seed, batch_size,
+                 validation_fraction, save_walks, compress, meta, start_nodes=None, first_relations=None):
+  '''
+  Samples the walks, from every node num_walks times or from the scheduled
+  start_nodes with their first_relations, and writes them as corpus text to train_file and
+  validation_file, and as a walk store to save_walks if it is set. Returns a
+  report of the walks that were produced.
+  '''
+  G = graph.G
+  tasks = iter_walk_tasks(graph, num_walks, walk_length, seed, batch_size, validation_fraction, save_walks is not None,
+                          start_nodes, first_relations)
+  total_walks, stuck_walks = 0, 0
+  hops = np.zeros(len(G.relation_names), dtype=np.int64)
+  writer = None
+  if save_walks:
+    writer = WalkStoreWriter(save_walks, G.node_names, G.relation_names, meta=meta)
+
+  with walk_pool(graph, workers) as pool, open_corpus(train_file, compress) as train, \
+       open_corpus(validation_file, compress) as validation:
+    for train_text, validation_text, walks, stats in tqdm(pool.imap(_walk_task, tasks)):
+      total_walks += stats[0]
+      stuck_walks += stats[1]
+      hops += stats[2]
+      train.write(train_text)
+      validation.write(validation_text)
+      if writer is not None:
+        writer.append(*walks)
+
+  if writer is not None:
+    writer.close()
+
+  return {
+    "walks": total_walks,
+    "single_node_walks": stuck_walks,
+    "hops": int(hops.sum()),
+    "hops_per_relation": {name: int(count) for name, count in zip(G.relation_names, hops.tolist())},
+  }
+
+
+def sweep_path(path, num_walks, walk_length):
+  '''
+  Adds the walk settings to a corpus file name, before any .txt or .gz suffix.
+  '''
+  stem, suffix = path, ""
+  for extension in (".gz", ".txt"):
+    if stem.endswith(extension):
+      stem, suffix = stem[:-len(extension)], extension + suffix
+  return "%s_%d_%d%s" % (stem, num_walks, walk_length, suffix)
+
+
+def run_pipeline(relations, relations_dir, train_file, validation_file, validation_fraction=0.05,
+                 p=1.0, q=1.0, num_walks=2, walk_length=15, workers=1, seed=42, batch_size=8192,
+                 save_assertions=None, save_walks=None, compress=False, cache_dir=None, cache_max_bytes=None,
+                 schedule=None, dead_end_walks=0, relation_quota=None):
+  '''
+  Reads the ConceptNet relation files of relations from relations_dir, samples
+  node2vec walks over the assertion graph and writes them as a MLM corpus to
+  train_file and validation_file. save_assertions and save_walks optionally
+  keep the assertions TSV and a walk store of the intermediate results.
+
+  num_walks and walk_length may be lists, in which case every combination is
+  generated from the same graph and alias tables, and the settings are added to
+  the output names. With a cache_dir, the graph, the alias tables and every
+  corpus are cached under a hash of their inputs and parameters (see
+  stage_cache.py), so reruns only compute the stages whose inputs changed.
+
+  By default every node starts num_walks walks, dead ends included. A schedule
+  strategy ("uniform", "degree" or "relation", see walk_scheduler.py) skips dead
+  ends, or walks dead_end_walks times from them, and allocates the walks by
+  degree or by relation_quota, a dict of relation (as in relations) to weight.
+  The schedule and a report of the walks produced are printed as JSON.
+  '''
+  cache = StageCache(cache_dir, cache_max_bytes) if cache_dir else None
+  relation_dict = dict(default_dict, **LAMA_dict)
+
+  graph_key = None
+  cached = None
+  if cache is not None:
+    graph_params = {"relations": relations, "relation_dict": {r: relation_dict[r] for r in relations}}
+    graph_key = cache.key("graph", graph_params, input_files=relation_paths(relations, relations_dir))
+    cache.flush()
+    cached = cache.lookup("graph", graph_key)
+  if cached is not None and not save_assertions:
+    print("Reusing cached graph %s" % graph_key)
+    csr_G = CSRGraph.load(cached)
+  else:
+    csr_G = build_graph(relations, relations_dir, save_assertions)
+    if cache is not None and cached is None:
+      with cache.store("graph", graph_key) as path:
+        csr_G.save(path)
+
+  graph = Graph(csr_G, True, p, q)
+  alias_key = None
+  cached = None
+  if cache is not None:
+    alias_key = cache.key("alias", {"p": p, "q": q}, upstream_keys=[graph_key])
+    cached = cache.lookup("alias", alias_key)
+  if cached is not None:
+    print("Reusing cached alias tables %s" % alias_key)
+    graph.load_alias_tables(cached)
+  else:
+    graph.preprocess_transition_probs()
+    if cache is not None:
+      with cache.store("alias", alias_key) as path:
+        graph.save_alias_tables(path)
+
+  settings = [(n, l) for n in np.atleast_1d(num_walks).tolist() for l in np.atleast_1d(walk_length).tolist()]
+  for walks_per_node, length in settings:
+    train_path, validation_path, walks_path = train_file, validation_file, save_walks
+    if len(settings) > 1:
+      train_path = sweep_path(train_file, walks_per_node, length)
+      validation_path = sweep_path(validation_file, walks_per_node, length)
+      walks_path = save_walks and "%s_%d_%d" % (save_walks, walks_per_node, length)
+    meta = {"relations": relations, "p": p, "q": q, "walks_per_node": walks_per_node, "walk_length": length, "seed": seed}
+    corpus_args = (length, workers, seed, batch_size, validation_fraction)
+    start_nodes, first_relations = None, None
+    if schedule is not None:
+      start_nodes, first_relations, meta["schedule"] = schedule_start_nodes(
+        csr_G, walks_per_node, schedule, dead_end_walks, relation_quota, seed)
+      print(json.dumps(meta["schedule"], indent=2))
+
+    if cache is None:
+      produced = write_corpus(graph, train_path, validation_path, walks_per_node, *corpus_args, walks_path, compress,
+                              meta, start_nodes, first_relations)
+      print(json.dumps(produced, indent=2))
+      continue
+
+    corpus_params = {"num_walks": walks_per_node, "walk_length": length, "seed": seed, "batch_size": batch_size,
+                     "validation_fraction": validation_fraction, "keep_walks": walks_path is not None, "compress": compress}
+    if schedule is not None:
+      corpus_params.update(schedule=schedule, dead_end_walks=dead_end_walks, relation_quota=relation_quota,
+                           first_hop_by_relation=schedule == "relation")
+    corpus_key = cache.key("corpus", corpus_params, upstream_keys=[alias_key])
+    cached = cache.lookup("corpus", corpus_key)
+    if cached is None:
+      with cache.store("corpus", corpus_key) as path:
+        produced = write_corpus(graph, os.path.join(path, "train"), os.path.join(path, "validation"), walks_per_node,
+                                *corpus_args, walks_path and os.path.join(path, "walks"), compress, meta, start_nodes,
+                                first_relations)
+        with open(os.path.join(path, "produced.json"), "w") as out:
+          json.dump(produced, out, indent=2)
+      cached = cache.lookup("corpus", corpus_key)
+    else:
+      print("Reusing cached corpus %s" % corpus_key)
+    if os.path.isfile(os.path.join(cached, "produced.json")):
+      with open(os.path.join(cached, "produced.json")) as f:
+        print(f.read())
+    copy_output(os.path.join(cached, "train"), train_path)
+    copy_output(os.path.join(cached, "validation"), validation_path)
+    if walks_path:
+      copy_output(os.path.join(cached, "walks"), walks_path)
+
+
+def copy_output(cached_path, output_path):
+  '''
+  Copies a cached file or walk store to where the caller asked for it. Copies
+  rather than links, so later writes to the output can not corrupt the cache.
+  '''
+  if os.path.dirname(output_path):
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+  if os.path.isdir(cached_path):
+    shutil.copytree(cached_path, output_path, dirs_exist_ok=True)
+  else:
+    shutil.copyfile(cached_path, output_path)
+
+
+def main():
+  parser = argparse.ArgumentParser(
+    description="Builds a MLM training corpus from ConceptNet relation files via node2vec random walks")
+  parser.add_argument("--relations", nargs="+", default=LAMA_relations, help="Relation types to include.")
+  parser.add_argument("--relations_dir", type=str, default="../data/concept_net/relations",
+                      help="Folder with the cn_<relation>.txt files.")
+  parser.add_argument("--train_file", type=str, default="../data/concept_net/lama_corpus_train.txt")
+  parser.add_argument("--validation_file", type=str, default="../data/concept_net/lama_corpus_val.txt")
+  parser.add_argument("--validation_fraction", type=float, default=0.05,
+                      help="Fraction of walks that go to the validation file.")
+  parser.add_argument("--p", type=float, default=1.0, help="Return hyperparameter.")
+  parser.add_argument("--q", type=float, default=1.0, help="Inout hyperparameter.")
+  parser.add_argument("--num_walks", type=int, nargs="+", default=[2],
+                      help="Number of walks per source. Several values sweep over them.")
+  parser.add_argument("--walk_length", type=int, nargs="+", default=[15],
+                      help="Length of walk per source, in tokens. Several values sweep over them.")
+  parser.add_argument("--workers", type=int, default=8, help="Number of parallel workers.")
+  parser.add_argument("--seed", type=int, default=42)
+  parser.add_argument("--batch_size", type=int, default=8192, help="Number of walks advanced together per task.")
+  parser.add_argument("--save_assertions", type=str, default=None, help="Also write the assertions TSV here.")
+  parser.add_argument("--save_walks", type=str, default=None, help="Also write the walks as a walk store here.")
+  parser.add_argument("--compress", action="store_true", help="Gzip the corpus files.")
+  parser.add_argument("--cache_dir", type=str, default=None,
+                      help="Cache the graph, alias tables and corpora here and reuse them when nothing changed.")
+  parser.add_argument("--cache_max_gb", type=float, default=None,
+                      help="Evict the least recently used cache entries beyond this size.")
+  parser.add_argument("--schedule", choices=STRATEGIES, default=None,
+                      help="Schedule the start nodes instead of walking from every node, dead ends included.")
+  parser.add_argument("--dead_end_walks", type=int, default=0,
+                      help="Walks per dead-end node with --schedule, 0 skips them.")
+  parser.add_argument("--relation_quota", nargs="+", default=None, metavar="RELATION=WEIGHT",
+                      help="Relative share of the walks per relation with --schedule relation, e.g. isA=2 usedFor=1. "
+                           "A walk's first hop follows an edge of its relation, relations left out get no walks.")
+  args = parser.parse_args()
+
+  relation_quota = None
+  if args.relation_quota:
+    relation_quota = {relation: float(weight) for relation, weight in (item.split("=") for item in args.relation_quota)}
+
+  run_pipeline(args.relations, args.relations_dir, args.train_file, args.validation_file,
+               validation_fraction=args.validation_fraction, p=args.p, q=args.q, num_walks=args.num_walks,
+               walk_length=args.walk_length, workers=args.workers, seed=args.seed, batch_size=args.batch_size,
+               save_assertions=args.save_assertions, save_walks=args.save_walks, compress=args.compress,
+               cache_dir=args.cache_dir,
+               cache_max_bytes=None if args.cache_max_gb is None else int(args.cache_max_gb * (1 << 30)),
+               schedule=args.schedule, dead_end_walks=args.dead_end_walks, relation_quota=relation_quota)
+
+
+if __name__ == "__main__":
+  main()
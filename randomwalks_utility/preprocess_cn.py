@@ -1,4 +1,8 @@
 import codecs
+import hashlib
+import os
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 # Modified from https://github.com/Wluper/Retrograph/blob/master/randomwalks_utility/preprocess_cn.py
 
@@ -60,25 +64,30 @@ LAMA_dict = {
   "usedFor": "is used for"
 } 
 
-def create_joined_assertions_for_random_walks(paths=[], relation_dict = default_dict, output_path="../data/concept_net/randomwalks/cn_assertions_filtered.tsv"):
-  counts = {}
-  all_assertions = []
+def read_assertions(paths, relation_dict=default_dict, counts=None):
+  '''
+  Yields the (word_a, word_b, relation) assertions of the relation files in
+  paths, with the relation in natural language. Antonyms and synonyms are
+  yielded in both directions. If counts is a dict, it is updated with the number
+  of lines read per relation.
+  '''
   for path in paths:
     relation = path.split("cn_")[1].split(".txt")[0]
     nl_relation = relation_dict[relation]
     with codecs.open(path, "r", "utf8") as f:
-      for line in f.readlines():
-        if nl_relation in counts:
-          counts[nl_relation] = counts[nl_relation] + 1
-        else:
-          counts[nl_relation] = 1
+      for line in f:
+        if counts is not None:
+          counts[nl_relation] = counts.get(nl_relation, 0) + 1
         word_a, word_b = line.strip().split("\t")
-        full_assertion = [word_a, word_b, nl_relation]
-        all_assertions.append(full_assertion)
+        yield word_a, word_b, nl_relation
         # Handle bidirectionality
         if relation == "antonyms" or relation == "synonyms":
-          full_assertion_b = [word_b, word_a, nl_relation]
-          all_assertions.append(full_assertion_b)
+          yield word_b, word_a, nl_relation
+
+
+def create_joined_assertions_for_random_walks(paths=[], relation_dict = default_dict, output_path="../data/concept_net/randomwalks/cn_assertions_filtered.tsv"):
+  counts = {}
+  all_assertions = list(read_assertions(paths, relation_dict, counts))
   print("In total, we have %d assertions" % len(all_assertions))
   print(counts)
   with codecs.open(output_path, "w", "utf8") as out:
@@ -87,10 +96,92 @@ def create_joined_assertions_for_random_walks(paths=[], relation_dict = default_
 
 
 
+def assertion_key(word_a, word_b, nl_relation=None):
+  '''
+  64 bit hash of an assertion, or of just its edge if nl_relation is None. A
+  uint64 array of these takes a fraction of the memory the strings would.
+  '''
+  text = word_a + "\t" + word_b if nl_relation is None else word_a + "\t" + word_b + "\t" + nl_relation
+  return int.from_bytes(hashlib.blake2b(text.encode("utf8"), digest_size=8).digest(), "little")
+
+
+def _write_relation_part(path, relation_dict, part_path, dedupe_edges, batch_size=1 << 16):
+  '''
+  Streams the assertions of one relation file to part_path, and their dedupe
+  keys, as uint64, to part_path + ".keys". Returns the number of lines read per
+  relation.
+  '''
+  keys = []
+  counts = {}
+  with codecs.open(part_path, "w", "utf8") as out, open(part_path + ".keys", "wb") as key_out:
+    for word_a, word_b, nl_relation in read_assertions([path], relation_dict, counts):
+      out.write(word_a + "\t" + word_b + "\t" + nl_relation + "\n")
+      keys.append(assertion_key(word_a, word_b, None if dedupe_edges else nl_relation))
+      if len(keys) >= batch_size:
+        key_out.write(np.array(keys, dtype=np.uint64).tobytes())
+        keys = []
+    key_out.write(np.array(keys, dtype=np.uint64).tobytes())
+  return counts
+
+
+def stream_joined_assertions_for_random_walks(paths=[], relation_dict=default_dict,
+                                              output_path="../data/concept_net/randomwalks/cn_assertions_filtered.tsv",
+                                              workers=4, dedupe_edges=False):
+  '''
+  Streaming version of create_joined_assertions_for_random_walks. Relation files
+  are read in parallel, each into its own part file, and the parts are copied to
+  output_path in the order of paths, dropping every assertion that was already
+  written. Only the 64 bit keys of the written assertions are kept in memory,
+  as a sorted uint64 array.
+
+  By default an assertion is a duplicate if head, tail and relation match. With
+  dedupe_edges, any assertion between an already connected head and tail is
+  dropped, which is what networkx does when it builds the graph, except that
+  the first relation is kept instead of the last.
+  '''
+  parts_dir = output_path + ".parts"
+  os.makedirs(parts_dir, exist_ok=True)
+  part_paths = [os.path.join(parts_dir, "%d.tsv" % i) for i in range(len(paths))]
+
+  counts = {}
+  kept = {}
+  seen = np.empty(0, dtype=np.uint64)
+  with ProcessPoolExecutor(max_workers=workers) as executor:
+    jobs = [executor.submit(_write_relation_part, path, relation_dict, part_path, dedupe_edges)
+            for path, part_path in zip(paths, part_paths)]
+    with codecs.open(output_path, "w", "utf8") as out:
+      for job, part_path in zip(jobs, part_paths):
+        for nl_relation, lines in job.result().items():
+          counts[nl_relation] = counts.get(nl_relation, 0) + lines
+        keys = np.fromfile(part_path + ".keys", dtype=np.uint64)
+        # The first line of every key in this part, unless an earlier part wrote it
+        part_keys, first = np.unique(keys, return_index=True)
+        positions = np.minimum(np.searchsorted(seen, part_keys), max(len(seen) - 1, 0))
+        new = seen[positions] != part_keys if len(seen) else np.ones(len(part_keys), dtype=bool)
+        keep = np.zeros(len(keys), dtype=bool)
+        keep[first[new]] = True
+        seen = np.union1d(seen, part_keys[new])
+        with codecs.open(part_path, "r", "utf8") as part:
+          for line, keep_line in zip(part, keep.tolist()):
+            if not keep_line:
+              continue
+            out.write(line)
+            nl_relation = line.rstrip("\n").split("\t")[2]
+            kept[nl_relation] = kept.get(nl_relation, 0) + 1
+        os.remove(part_path)
+        os.remove(part_path + ".keys")
+  os.rmdir(parts_dir)
+
+  print("In total, we have %d assertions" % len(seen))
+  print(counts)
+  print("Unique assertions per relation: %s" % kept)
+  return counts, kept
+
+
 def main():
   paths = [f"../data/concept_net/relations/cn_{x}.txt" for x in LAMA_relations] #Specify the relations you want to include.
   relation_dict = LAMA_dict
-  create_joined_assertions_for_random_walks(paths=paths, relation_dict=relation_dict)
+  stream_joined_assertions_for_random_walks(paths=paths, relation_dict=relation_dict)
   
 
 if __name__ == "__main__":
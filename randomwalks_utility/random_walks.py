@@ -1,8 +1,15 @@
 import numpy as np
-import networkx as nx
 import random
 import pickle
 import os
+import multiprocessing
+import hashlib
+import json
+import shutil
+from contextlib import contextmanager
+from walk_store import WalkStore, WalkStoreWriter, load_walks, read_names, write_names
+from graph_stats import graph_statistics
+from walk_scheduler import schedule_start_nodes
 
 ### Modified from https://github.com/Wluper/Retrograph/blob/master/randomwalks_utility/random_walks.py
 
@@ -25,55 +32,341 @@ LAMA_relations = [
   "usedFor"
 ] 
 
-def read_graph(path):
+def read_graph(path, as_networkx=False):
   '''
-  Reads the input network in networkx.
+  Reads the input network into a CSRGraph, or into a networkx DiGraph with
+  as_networkx=True.
   '''
-
-  G = nx.read_edgelist(path, nodetype=str, data=(('edge_type', str),), create_using=nx.DiGraph(), delimiter="\t")
-  for edge in G.edges():
-    G[edge[0]][edge[1]]['weight'] = 1
+  src, dst, edge_types, node_names, relation_names = load_edge_arrays(path)
+  G = CSRGraph.from_edges(src, dst, edge_types, node_names, relation_names)
+  if as_networkx:
+    return G.to_networkx()
   return G
 
 
+def load_edge_arrays(path, chunk_bytes=1 << 24):
+  '''
+  Parses a tab separated head, tail, relation file in chunks of about chunk_bytes
+  into int32 edge arrays. Node and relation names are interned and numbered in
+  the order they are first seen. Lines are parsed like nx.read_edgelist does.
+  Returns src, dst, edge_types, node_names and relation_names.
+  '''
+  node_ids = {}
+  relation_ids = {}
+  src, dst, edge_types = [], [], []
+  with open(path, "r", encoding="utf8") as f:
+    while True:
+      lines = f.readlines(chunk_bytes)
+      if not lines:
+        break
+      fields = _split_chunk(lines, path)
+      chunk = intern_edges(fields[0::3], fields[1::3], fields[2::3], node_ids, relation_ids)
+      src.append(chunk[0])
+      dst.append(chunk[1])
+      edge_types.append(chunk[2])
+  if not src:
+    empty = np.zeros(0, dtype=np.int32)
+    return empty, empty, empty, [], []
+  return np.concatenate(src), np.concatenate(dst), np.concatenate(edge_types), list(node_ids), list(relation_ids)
+
+
+def _split_chunk(lines, path):
+  '''
+  Splits lines of the assertions file into one flat list of head, tail and
+  relation fields.
+  '''
+  text = "".join(lines)
+  if not text.endswith("\n"):
+    text += "\n"
+  # Fast path for the common case of clean lines with exactly three fields
+  if text.count("\t") == 2 * len(lines) and not any(c in text for c in "#\r") \
+     and " \n" not in text and "\n " not in text and not text[0].isspace():
+    return text[:-1].replace("\n", "\t").split("\t")
+
+  fields = []
+  for line in lines:
+    # like nx.read_edgelist, drop everything after a "#" and lines with fewer than two fields
+    row = (line[:line.find("#")] if "#" in line else line).strip().split("\t")
+    if len(row) < 2:
+      continue
+    if len(row) != 3:
+      raise ValueError("Expected head, tail and relation on every line of %s, got %r" % (path, line))
+    fields.extend(row)
+  return fields
+
+
+def intern_edges(heads, tails, relations, node_ids, relation_ids):
+  '''
+  Maps lists of head, tail and relation names to int32 id arrays, adding unseen
+  names to the node_ids and relation_ids dicts in first-seen order.
+  '''
+  ends = [None] * (2 * len(heads))
+  ends[0::2] = heads
+  ends[1::2] = tails
+  for name in dict.fromkeys(ends):
+    if name not in node_ids:
+      node_ids[name] = len(node_ids)
+  for name in dict.fromkeys(relations):
+    if name not in relation_ids:
+      relation_ids[name] = len(relation_ids)
+  end_ids = np.fromiter(map(node_ids.__getitem__, ends), dtype=np.int32, count=len(ends))
+  relation_ids = np.fromiter(map(relation_ids.__getitem__, relations), dtype=np.int32, count=len(relations))
+  return end_ids[0::2], end_ids[1::2], relation_ids
+
+
+CSR_ARRAYS = ["indptr", "indices", "edge_types", "node_order"]
+
+
+class CSRGraph():
+  '''
+  Compact directed graph in compressed sparse row (CSR) layout.
+
+  Nodes are integer ids ordered like their names, so each CSR row lists its
+  neighbors in the same order as sorted(nx_G.neighbors(node)). The neighbors of
+  node i are indices[indptr[i]:indptr[i + 1]] and edge_types holds the relation
+  id of every edge. Edge weights are implicit and always 1, as in read_graph.
+  node_order lists the node ids in the order they were first seen, which is the
+  order list(nx_G.nodes()) returns.
+  '''
+  def __init__(self, node_names, relation_names, indptr, indices, edge_types, node_order):
+    self.node_names = node_names
+    self.relation_names = relation_names
+    self.node_ids = {name: i for i, name in enumerate(node_names)}
+    self.indptr = indptr
+    self.indices = indices
+    self.edge_types = edge_types
+    self.node_order = node_order
+    # directory the arrays are memory-mapped from, set by load
+    self.path = None
+
+  @classmethod
+  def from_edges(cls, src, dst, edge_types, node_names, relation_names):
+    '''
+    Builds the graph from parallel edge arrays. src and dst index node_names,
+    which must be in first-seen order. Like nx.DiGraph, a repeated edge keeps the
+    edge type of its last occurrence.
+    '''
+    num_nodes = len(node_names)
+    by_name = sorted(range(num_nodes), key=node_names.__getitem__)
+    rank = np.empty(num_nodes, dtype=np.int64)
+    rank[by_name] = np.arange(num_nodes, dtype=np.int64)
+
+    keys = rank[np.asarray(src, dtype=np.int64)] * num_nodes + rank[np.asarray(dst, dtype=np.int64)]
+    # np.unique keeps the first index of each key, so run it on the reversed arrays to keep the last occurrence
+    keys, last = np.unique(keys[::-1], return_index=True)
+    edge_types = np.asarray(edge_types, dtype=np.int32)[::-1][last]
+
+    rows = keys // num_nodes
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+    indices = (keys % num_nodes).astype(np.int32)
+    return cls([node_names[i] for i in by_name], list(relation_names), indptr, indices, edge_types, rank)
+
+  @classmethod
+  def from_triples(cls, triples):
+    '''
+    Builds the graph from (head, tail, relation) name triples, as found in the
+    assertions file.
+    '''
+    node_ids = {}
+    relation_ids = {}
+    triples = list(triples)
+    src, dst, edge_types = intern_edges([t[0] for t in triples], [t[1] for t in triples], [t[2] for t in triples],
+                                        node_ids, relation_ids)
+    return cls.from_edges(src, dst, edge_types, list(node_ids), list(relation_ids))
+
+  @classmethod
+  def from_networkx(cls, nx_G):
+    '''
+    Builds the graph from a networkx DiGraph with an edge_type edge attribute.
+    '''
+    node_names = list(nx_G.nodes())
+    position = {name: i for i, name in enumerate(node_names)}
+    relation_ids = {}
+    src, dst, edge_types = [], [], []
+    for u, v, edge_type in nx_G.edges(data="edge_type"):
+      src.append(position[u])
+      dst.append(position[v])
+      edge_types.append(relation_ids.setdefault(edge_type, len(relation_ids)))
+    return cls.from_edges(src, dst, edge_types, node_names, list(relation_ids))
+
+  def to_networkx(self):
+    '''
+    Exports the graph as a networkx DiGraph with edge_type and weight edge
+    attributes, as the old networkx based read_graph returned it.
+    '''
+    import networkx as nx
+    nx_G = nx.DiGraph()
+    nx_G.add_nodes_from(self.node_names[i] for i in self.node_order.tolist())
+    sources = np.repeat(np.arange(self.number_of_nodes()), np.diff(self.indptr)).tolist()
+    nx_G.add_edges_from(
+      (self.node_names[u], self.node_names[v], {"edge_type": self.relation_names[t], "weight": 1})
+      for u, v, t in zip(sources, self.indices.tolist(), self.edge_types.tolist()))
+    return nx_G
+
+  def save(self, path):
+    '''
+    Writes the graph arrays as .npy files plus the node and relation names to
+    the directory path.
+    '''
+    os.makedirs(path, exist_ok=True)
+    for name in CSR_ARRAYS:
+      np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+    write_names(os.path.join(path, "nodes.txt"), self.node_names)
+    write_names(os.path.join(path, "relations.txt"), self.relation_names)
+
+  @classmethod
+  def load(cls, path, mmap_mode="r"):
+    '''
+    Opens a graph written by save. The arrays are memory-mapped by default.
+    '''
+    arrays = [np.load(os.path.join(path, name + ".npy"), mmap_mode=mmap_mode) for name in CSR_ARRAYS]
+    graph = cls(read_names(os.path.join(path, "nodes.txt")), read_names(os.path.join(path, "relations.txt")), *arrays)
+    if mmap_mode is not None:
+      graph.path = path
+    return graph
+
+  def fingerprint(self):
+    '''
+    Hashes the graph's structure, edge types and names, so equal graphs share
+    persisted alias tables no matter which file they were read from.
+    '''
+    digest = hashlib.sha256()
+    for name in CSR_ARRAYS:
+      digest.update(np.ascontiguousarray(getattr(self, name), dtype=np.int64).tobytes())
+    digest.update("\n".join(self.node_names).encode("utf8"))
+    digest.update("\n".join(self.relation_names).encode("utf8"))
+    return digest.hexdigest()[:16]
+
+  def __getstate__(self):
+    # A memory-mapped graph is pickled as its path, the receiving process maps it again
+    if self.path is not None:
+      return {"path": self.path}
+    return self.__dict__
+
+  def __setstate__(self, state):
+    if "node_names" not in state:
+      state = CSRGraph.load(state["path"]).__dict__
+    self.__dict__.update(state)
+
+  def number_of_nodes(self):
+    return len(self.node_names)
+
+  def number_of_edges(self):
+    return len(self.indices)
+
+  def neighbors(self, node):
+    return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+  def degree(self, node):
+    return int(self.indptr[node + 1] - self.indptr[node])
+
+  def edge_index(self, src, dst):
+    '''
+    Returns the CSR offset of the edge src -> dst, or -1 if there is none.
+    '''
+    lo, hi = self.indptr[src], self.indptr[src + 1]
+    pos = lo + np.searchsorted(self.indices[lo:hi], dst)
+    if pos < hi and self.indices[pos] == dst:
+      return int(pos)
+    return -1
+
+  def has_edge(self, src, dst):
+    return self.edge_index(src, dst) >= 0
+
+  def edge_indices(self, src, dst):
+    '''
+    Vectorized edge_index: the CSR offsets of the edges src[i] -> dst[i], -1
+    where there is no such edge or either end is -1.
+    '''
+    num_nodes = self.number_of_nodes()
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    if self.number_of_edges() == 0:
+      return np.full(len(src), -1, dtype=np.int64)
+    # Row-major CSR order makes these keys sorted
+    edge_keys = np.repeat(np.arange(num_nodes, dtype=np.int64), np.diff(self.indptr)) * num_nodes + self.indices
+    keys = src * num_nodes + dst
+    pos = np.minimum(np.searchsorted(edge_keys, keys), len(edge_keys) - 1)
+    return np.where((edge_keys[pos] == keys) & (src >= 0) & (dst >= 0), pos, -1)
+
+  def relation_edge_ranges(self, nodes, relations):
+    '''
+    Returns the CSR offsets of all edges ordered by source and relation, and
+    for every nodes[i] the range lo[i]:hi[i] of that order holding its edges of
+    relation relations[i]. The order is computed once and kept.
+    '''
+    if getattr(self, "_relation_order", None) is None:
+      sources = np.repeat(np.arange(self.number_of_nodes(), dtype=np.int64), np.diff(self.indptr))
+      keys = sources * len(self.relation_names) + self.edge_types
+      self._relation_order = np.argsort(keys, kind="stable")
+      self._relation_keys = keys[self._relation_order]
+    keys = np.asarray(nodes, dtype=np.int64) * len(self.relation_names) + relations
+    lo = np.searchsorted(self._relation_keys, keys, "left")
+    hi = np.searchsorted(self._relation_keys, keys, "right")
+    return self._relation_order, lo, hi
+
+
 class Graph():
   def __init__(self, nx_G, is_directed, p, q):
+    if not isinstance(nx_G, CSRGraph):
+      nx_G = CSRGraph.from_networkx(nx_G)
     self.G = nx_G
     self.is_directed = is_directed
     self.p = p
     self.q = q
+    # directory the alias arrays are memory-mapped from, set by load_alias_tables
+    self.alias_path = None
 
   def node2vec_walk(self, walk_length, start_node):
     '''
     Simulate a random walk starting from start node.
     '''
     G = self.G
-    alias_nodes = self.alias_nodes
-    alias_edges = self.alias_edges
+    walk = self.node2vec_walk_ids(walk_length, G.node_ids[start_node])
+    return self.decode_walk(walk)
+
+  def decode_walk(self, walk):
+    '''
+    Maps a walk of node and relation ids back to their names.
+    '''
+    G = self.G
+    return [G.relation_names[token] if i % 2 else G.node_names[token] for i, token in enumerate(walk)]
+
+  def node2vec_walk_ids(self, walk_length, start_node, rng=None):
+    '''
+    Simulate a random walk starting from the start node id. The walk alternates
+    node ids and relation ids. Draws come from rng, a numpy Generator, or from
+    the global np.random state if it is None.
+    '''
+    G = self.G
+    indptr = G.indptr
+    indices = G.indices
+    edge_types = G.edge_types
+    alias_J = self.alias_J
+    alias_q = self.alias_q
+    node_alias_start = self.node_alias_start
+    edge_alias_start = self.edge_alias_start
 
     walk = [start_node]
+    # CSR offset of the edge we arrived by, it indexes edge_alias_start
+    last_edge = -1
 
     while len(walk) < walk_length:
       cur = walk[-1]
-      cur_nbrs = sorted(G.neighbors(cur))
-      if len(cur_nbrs) > 0:
-        if len(walk) == 1:
+      lo, hi = indptr[cur], indptr[cur + 1]
+      if hi > lo:
+        if len(walk) == 1 or edge_alias_start is None:
           # TODO: This is Annes main change to the code, the rest is original node2vec code
           # NEW
-          n = cur_nbrs[alias_draw(alias_nodes[cur][0], alias_nodes[cur][1])]
-          walk.append(G.get_edge_data(cur, n)["edge_type"])
-          walk.append(n)
-
-          #walk.append(cur_nbrs[alias_draw(alias_nodes[cur][0], alias_nodes[cur][1])])
+          start = node_alias_start[cur]
         else:
-          #prev = walk[-2]
-          prev = walk[-3]
-          next = cur_nbrs[alias_draw(alias_edges[(prev, cur)][0],
-                                     alias_edges[(prev, cur)][1])]
-          ## new
-          walk.append(G.get_edge_data(cur, next)["edge_type"])
-          ####
-          walk.append(next)
+          start = edge_alias_start[last_edge]
+        end = start + (hi - lo)
+        edge = lo + alias_draw(alias_J[start:end], alias_q[start:end], rng)
+        walk.append(int(edge_types[edge]))
+        walk.append(int(indices[edge]))
+        last_edge = edge
       else:
         break
 
@@ -85,16 +378,247 @@ class Graph():
     '''
     G = self.G
     walks = []
-    nodes = list(G.nodes())
-    print
-    'Walk iteration:'
+    nodes = G.node_order.tolist()
+    print('Walk iteration:')
     for walk_iter in range(num_walks):
-      print
-      str(walk_iter + 1), '/', str(num_walks)
+      print(str(walk_iter + 1), '/', str(num_walks))
       random.shuffle(nodes)
       for node in nodes:
-        walks.append(self.node2vec_walk(walk_length=walk_length, start_node=node))
+        walks.append(self.node2vec_walk(walk_length=walk_length, start_node=G.node_names[node]))
+
+    return walks
+
+  def walk_batch(self, start_nodes, walk_length, rng, last_edges=None, first_relations=None):
+    '''
+    Walks once from every start node id, advancing all walks together: every
+    hop draws the alias samples of all live walks with one rng call. Walks end
+    early at dead-end nodes, which are masked out of later hops. Returns the
+    walks as one flat int32 token array, alternating node and relation ids like
+    node2vec_walk_ids, plus the offsets where each walk begins.
+
+    walk_length may also be an array with the length of every walk. last_edges
+    optionally holds the CSR offset of the edge each walk arrived at its start
+    node by, -1 for none, to continue walks that were cut short. first_relations
+    optionally holds a relation id per walk, the first hop is then drawn
+    uniformly among the start node's edges of that relation, -1 leaves the hop
+    free.
+    '''
+    G = self.G
+    alias_J = self.alias_J
+    alias_q = self.alias_q
+    edge_alias_start = self.edge_alias_start
+    num_walks = len(start_nodes)
+    # node2vec_walk_ids keeps taking hops of two tokens while the walk is shorter than walk_length
+    walk_hops = np.broadcast_to(np.maximum(walk_length, 0) // 2, (num_walks,))
+    hops = int(walk_hops.max()) if num_walks else 0
+
+    out = np.empty((num_walks, 1 + 2 * hops), dtype=np.int32)
+    out[:, 0] = start_nodes
+    lengths = np.ones(num_walks, dtype=np.int64)
+    cur = np.asarray(start_nodes, dtype=np.int64)
+    last_edge = np.full(num_walks, -1, dtype=np.int64) if last_edges is None else np.array(last_edges, dtype=np.int64)
+    active = np.arange(num_walks)
+
+    for hop in range(hops):
+      lo = G.indptr[cur[active]]
+      degrees = G.indptr[cur[active] + 1] - lo
+      alive = (degrees > 0) & (walk_hops[active] > hop)
+      active, lo, degrees = active[alive], lo[alive], degrees[alive]
+      if len(active) == 0:
+        break
+      if edge_alias_start is None or (hop == 0 and last_edges is None):
+        start = self.node_alias_start[cur[active]]
+      else:
+        arrived = last_edge[active]
+        start = np.where(arrived >= 0, edge_alias_start[arrived], self.node_alias_start[cur[active]])
+
+      draws = rng.random((2, len(active)))
+      kk = np.minimum((draws[0] * degrees).astype(np.int64), degrees - 1)
+      picks = np.where(draws[1] < alias_q[start + kk], kk, alias_J[start + kk])
+      edges = lo + picks
+      if hop == 0 and first_relations is not None:
+        relations = np.asarray(first_relations, dtype=np.int64)[active]
+        order, r_lo, r_hi = G.relation_edge_ranges(cur[active], relations)
+        steered = (relations >= 0) & (r_hi > r_lo)
+        # Edge weights are always 1, so the first hop is uniform among the edges of the relation
+        choice = r_lo[steered] + np.minimum((draws[0][steered] * (r_hi - r_lo)[steered]).astype(np.int64),
+                                            (r_hi - r_lo)[steered] - 1)
+        edges[steered] = order[choice]
+
+      out[active, 2 * hop + 1] = G.edge_types[edges]
+      out[active, 2 * hop + 2] = G.indices[edges]
+      lengths[active] += 2
+      cur[active] = G.indices[edges]
+      last_edge[active] = edges
+
+    bounds = np.zeros(num_walks + 1, dtype=np.int64)
+    np.cumsum(lengths, out=bounds[1:])
+    tokens = out[np.arange(out.shape[1]) < lengths[:, None]]
+    return tokens, bounds
+
+  def iter_walk_batches(self, num_walks, walk_length, seed=None, batch_size=8192):
+    '''
+    Yields the walks of simulate_walks_batched as (tokens, bounds) batches from
+    walk_batch, without decoding them to names.
+    '''
+    G = self.G
+    rng = np.random.default_rng(seed)
+    print('Walk iteration:')
+    for walk_iter in range(num_walks):
+      print(str(walk_iter + 1), '/', str(num_walks))
+      nodes = rng.permutation(G.node_order)
+      for first in range(0, len(nodes), batch_size):
+        yield self.walk_batch(nodes[first:first + batch_size], walk_length, rng)
+
+  def simulate_walks_batched(self, num_walks, walk_length, seed=None, batch_size=8192):
+    '''
+    Same as simulate_walks, but walks batch_size start nodes at a time with
+    walk_batch, drawing from a numpy Generator seeded with seed.
+    '''
+    return self.decode_walk_batches(self.iter_walk_batches(num_walks, walk_length, seed, batch_size))
+
+  def iter_walk_batches_parallel(self, num_walks, walk_length, workers=8, seed=0, batch_size=8192):
+    '''
+    Yields the walks of simulate_walks_parallel as (tokens, bounds) batches in
+    walk iteration order, as soon as the workers finish them, without decoding
+    them to names.
+    '''
+    G = self.G
+    seed_sequence = np.random.SeedSequence(seed)
+    shuffle_rng = np.random.default_rng(seed_sequence.spawn(1)[0])
+
+    def tasks():
+      for walk_iter in range(num_walks):
+        nodes = shuffle_rng.permutation(G.node_order)
+        for first in range(0, len(nodes), batch_size):
+          yield nodes[first:first + batch_size], walk_length, seed_sequence.spawn(1)[0], None
+
+    with walk_pool(self, workers) as pool:
+      for tokens, bounds in pool.imap(_simulate_shard, tasks()):
+        yield tokens, bounds
+
+  def simulate_walks_parallel(self, num_walks, walk_length, workers=8, seed=0, batch_size=8192):
+    '''
+    Same as simulate_walks, but every walk iteration splits the shuffled start
+    nodes into tasks of batch_size that worker processes walk. Each task draws
+    from its own numpy Generator spawned from seed, so the walks only depend on
+    seed and batch_size, not on the number of workers. With the fork start
+    method the workers inherit the graph and alias arrays instead of receiving
+    a pickled copy.
+    '''
+    return self.decode_walk_batches(self.iter_walk_batches_parallel(num_walks, walk_length, workers, seed, batch_size))
+
+  def iter_scheduled_walk_batches(self, start_nodes, walk_length, seed=None, batch_size=8192, workers=1,
+                                  first_relations=None):
+    '''
+    Walks once from every start node id in start_nodes, as scheduled by
+    walk_scheduler.schedule_start_nodes, and yields the walks as (tokens, bounds)
+    batches. first_relations, if given, is the relation of every walk's first
+    hop, see walk_batch. With workers > 1 the start nodes are split into tasks of
+    batch_size for the worker processes, each drawing from a Generator spawned
+    from seed.
+    '''
+    if workers <= 1:
+      rng = np.random.default_rng(seed)
+      for first in range(0, len(start_nodes), batch_size):
+        yield self.walk_batch(start_nodes[first:first + batch_size], walk_length, rng,
+                              first_relations=_slice(first_relations, first, first + batch_size))
+      return
+
+    seed_sequence = np.random.SeedSequence(seed)
+    tasks = ((start_nodes[first:first + batch_size], walk_length, seed_sequence.spawn(1)[0],
+              _slice(first_relations, first, first + batch_size))
+             for first in range(0, len(start_nodes), batch_size))
+    with walk_pool(self, workers) as pool:
+      for tokens, bounds in pool.imap(_simulate_shard, tasks):
+        yield tokens, bounds
+
+  def simulate_scheduled_walks(self, num_walks, walk_length, strategy="uniform", dead_end_walks=0, relation_quota=None,
+                               seed=None, batch_size=8192, workers=1):
+    '''
+    Same as simulate_walks_batched, but the start nodes come from
+    walk_scheduler.schedule_start_nodes, which skips dead ends and can allocate
+    the walks by degree or by relation. Returns the walks and the schedule report.
+    '''
+    start_nodes, first_relations, report = schedule_start_nodes(self.G, num_walks, strategy, dead_end_walks,
+                                                                relation_quota, seed)
+    batches = self.iter_scheduled_walk_batches(start_nodes, walk_length, seed, batch_size, workers, first_relations)
+    return self.decode_walk_batches(batches), report
+
+  def iter_updated_walk_batches(self, store, old_of_new, affected, seed=None, batch_size=8192, stats=None):
+    '''
+    Brings the walks of store, a WalkStore sampled from an older version of this
+    graph, up to date and yields them as (tokens, bounds) batches. old_of_new
+    comes from diff_graphs and affected from affected_nodes. Walks that never
+    visit an affected node are kept as they are. The others keep their prefix up
+    to the first affected node and are walked on from there, which gives them
+    the same distribution as walks sampled from scratch. Walks from removed
+    nodes are dropped and new nodes get walks_per_node fresh walks each. The
+    number of kept, continued, dropped and new walks is counted in stats.
+    '''
+    G = self.G
+    walk_length = store.meta["walk_length"]
+    rng = np.random.default_rng(seed)
+    stats = {} if stats is None else stats
+    stats.update(kept=0, continued=0, dropped=0, new=0)
+
+    present = np.flatnonzero(old_of_new >= 0)
+    new_of_old = np.full(len(store.node_names), -1, dtype=np.int64)
+    new_of_old[old_of_new[present]] = present
+    relation_ids = {name: i for i, name in enumerate(G.relation_names)}
+    new_relation_of_old = np.array([relation_ids.get(name, -1) for name in store.relation_names], dtype=np.int64)
+
+    for first in range(0, len(store), batch_size):
+      bounds = np.array(store.offsets[first:min(first + batch_size, len(store)) + 1])
+      tokens = np.asarray(store.tokens[bounds[0]:bounds[-1]])
+      bounds -= bounds[0]
+      lengths = np.diff(bounds)
+      positions = np.arange(len(tokens)) - np.repeat(bounds[:-1], lengths)
+      is_node = positions % 2 == 0
+      mapped = np.empty(len(tokens), dtype=np.int64)
+      mapped[is_node] = new_of_old[tokens[is_node]]
+      mapped[~is_node] = new_relation_of_old[tokens[~is_node]]
+
+      # Position of the first affected node of every walk, its length if there is none
+      hit = is_node & ((mapped < 0) | affected[np.maximum(mapped, 0)])
+      first_hit = np.minimum.reduceat(np.where(hit, positions, len(tokens)), bounds[:-1])
+      first_hit = np.minimum(first_hit, lengths)
+      survives = mapped[bounds[:-1]] >= 0
+      cut = np.flatnonzero(survives & (first_hit < lengths))
+      keep_lengths = first_hit
+
+      cut_at = bounds[cut] + first_hit[cut]
+      restart = mapped[cut_at]
+      arrived = np.where(first_hit[cut] > 0, G.edge_indices(mapped[np.maximum(cut_at - 2, 0)], restart), -1)
+      new_tokens, new_bounds = self.walk_batch(restart, walk_length - first_hit[cut], rng, arrived)
 
+      walks = np.flatnonzero(survives)
+      added = np.zeros(len(lengths), dtype=np.int64)
+      added[cut] = np.diff(new_bounds)
+      out_bounds = np.zeros(len(walks) + 1, dtype=np.int64)
+      np.cumsum(keep_lengths[walks] + added[walks], out=out_bounds[1:])
+      out = np.empty(out_bounds[-1], dtype=np.int32)
+      out[_segments(out_bounds[:-1], keep_lengths[walks])] = mapped[_segments(bounds[walks], keep_lengths[walks])]
+      cut_rows = np.searchsorted(walks, cut)
+      out[_segments(out_bounds[cut_rows] + keep_lengths[cut], added[cut])] = new_tokens
+
+      stats["kept"] += len(walks) - len(cut)
+      stats["continued"] += len(cut)
+      stats["dropped"] += len(lengths) - len(walks)
+      yield out, out_bounds
+
+    new_nodes = np.flatnonzero(old_of_new < 0)
+    for walk_iter in range(store.meta["walks_per_node"]):
+      nodes = rng.permutation(new_nodes)
+      for first in range(0, len(nodes), batch_size):
+        stats["new"] += len(nodes[first:first + batch_size])
+        yield self.walk_batch(nodes[first:first + batch_size], walk_length, rng)
+
+  def decode_walk_batches(self, batches):
+    walks = []
+    for tokens, bounds in batches:
+      for i in range(len(bounds) - 1):
+        walks.append(self.decode_walk(tokens[bounds[i] - bounds[0]:bounds[i + 1] - bounds[0]].tolist()))
     return walks
 
   def get_alias_edge(self, src, dst):
@@ -106,48 +630,347 @@ class Graph():
     q = self.q
 
     unnormalized_probs = []
-    for dst_nbr in sorted(G.neighbors(dst)):
+    for dst_nbr in G.neighbors(dst):
       if dst_nbr == src:
-        unnormalized_probs.append(G[dst][dst_nbr]['weight'] / p)
+        unnormalized_probs.append(1 / p)
       elif G.has_edge(dst_nbr, src):
-        unnormalized_probs.append(G[dst][dst_nbr]['weight'])
+        unnormalized_probs.append(1)
       else:
-        unnormalized_probs.append(G[dst][dst_nbr]['weight'] / q)
-    norm_const = sum(unnormalized_probs)
-    normalized_probs = [float(u_prob) / norm_const for u_prob in unnormalized_probs]
+        unnormalized_probs.append(1 / q)
 
-    return alias_setup(normalized_probs)
+    return alias_setup(normalize(unnormalized_probs))
 
-  def preprocess_transition_probs(self):
+  def preprocess_transition_probs(self, max_entries_per_batch=1 << 22):
     '''
     Preprocessing of transition probabilities for guiding the random walks.
+
+    All alias tables live in one pool of flat arrays, alias_J and alias_q, and
+    identical tables are stored only once. node_alias_start[node] and
+    edge_alias_start[edge] point into the pool, where edge is the CSR offset of
+    the edge the walk arrived by, and a table is as long as the out-degree of
+    the node it samples from. With p == q == 1 the second order bias is a no-op,
+    so no edge tables are built and edge_alias_start is None.
     '''
     G = self.G
-    is_directed = self.is_directed
+    p = self.p
+    q = self.q
+    num_nodes = G.number_of_nodes()
+    degrees = np.diff(G.indptr)
 
-    alias_nodes = {}
-    for node in G.nodes():
-      unnormalized_probs = [G[node][nbr]['weight'] for nbr in sorted(G.neighbors(node))]
-      norm_const = sum(unnormalized_probs)
-      normalized_probs = [float(u_prob) / norm_const for u_prob in unnormalized_probs]
-      alias_nodes[node] = alias_setup(normalized_probs)
+    pool = AliasPool()
 
-    alias_edges = {}
-    triads = {}
+    # Unit weights make every first order table uniform, so there is one per degree
+    node_alias_start = np.zeros(num_nodes, dtype=np.int64)
+    for degree in np.unique(degrees[degrees > 0]).tolist():
+      node_alias_start[degrees == degree] = pool.uniform(degree)
 
-    if is_directed:
-      for edge in G.edges():
-        alias_edges[edge] = self.get_alias_edge(edge[0], edge[1])
-    else:
-      for edge in G.edges():
-        alias_edges[edge] = self.get_alias_edge(edge[0], edge[1])
-        alias_edges[(edge[1], edge[0])] = self.get_alias_edge(edge[1], edge[0])
+    edge_alias_start = None
+    if not (p == 1 and q == 1):
+      # Every edge of the directed graph is stored in the CSR arrays, and a walk can
+      # only arrive over one of them, so is_directed needs no special casing here.
+      edge_alias_start = np.zeros(G.number_of_edges(), dtype=np.int64)
+      self._pool_edge_tables(pool, edge_alias_start, max_entries_per_batch)
 
-    self.alias_nodes = alias_nodes
-    self.alias_edges = alias_edges
+    self.alias_J, self.alias_q = pool.arrays()
+    self.node_alias_start = node_alias_start
+    self.edge_alias_start = edge_alias_start
 
     return
 
+  def update_transition_probs(self, previous, old_of_new, changed, max_entries_per_batch=1 << 22):
+    '''
+    Builds the alias tables like preprocess_transition_probs, reusing the tables
+    of previous, a Graph with the same p and q over an older version of this
+    graph. old_of_new and changed come from diff_graphs. Only nodes whose
+    out-edges changed get new node tables, and only edges into nodes that
+    changed or link to a changed node get new edge tables, the rest point into
+    the pool of previous, which the new pool extends.
+    '''
+    G = self.G
+    old_G = previous.G
+    degrees = np.diff(G.indptr)
+    pool = AliasPool(previous.alias_J, previous.alias_q)
+
+    node_alias_start = np.zeros(G.number_of_nodes(), dtype=np.int64)
+    kept = (old_of_new >= 0) & ~changed
+    node_alias_start[kept] = previous.node_alias_start[old_of_new[kept]]
+    old_degrees = np.diff(old_G.indptr)
+    for degree in np.unique(degrees[~kept & (degrees > 0)]).tolist():
+      # Any old node of the same degree already has the uniform table
+      donors = np.flatnonzero(old_degrees == degree)
+      offset = previous.node_alias_start[donors[0]] if len(donors) else pool.uniform(degree)
+      node_alias_start[~kept & (degrees == degree)] = offset
+
+    edge_alias_start = None
+    if not (self.p == 1 and self.q == 1):
+      edge_alias_start = np.zeros(G.number_of_edges(), dtype=np.int64)
+      sources = np.repeat(np.arange(G.number_of_nodes()), degrees)
+      old_edges = old_G.edge_indices(old_of_new[sources], old_of_new[G.indices])
+      reuse = (old_edges >= 0) & ~affected_nodes(G, changed, second_order=True)[G.indices]
+      edge_alias_start[reuse] = previous.edge_alias_start[old_edges[reuse]]
+      self._pool_edge_tables(pool, edge_alias_start, max_entries_per_batch, edges=np.flatnonzero(~reuse))
+
+    self.alias_J, self.alias_q = pool.arrays()
+    self.node_alias_start = node_alias_start
+    self.edge_alias_start = edge_alias_start
+
+  def _pool_edge_tables(self, pool, edge_alias_start, max_entries_per_batch, edges=None):
+    weights = [1 / self.p, 1, 1 / self.q]
+    for edges, codes, bounds in self._second_order_codes(max_entries_per_batch, edges):
+      raw = codes.tobytes()
+      for i, edge in enumerate(edges.tolist()):
+        key = raw[bounds[i]:bounds[i + 1]]
+        edge_alias_start[edge] = pool.offset(key, lambda: normalize([weights[code] for code in key]))
+
+  def save_alias_tables(self, path):
+    '''
+    Writes the alias arrays built by preprocess_transition_probs as .npy files to
+    the directory path.
+    '''
+    os.makedirs(path, exist_ok=True)
+    for name in ALIAS_ARRAYS:
+      if getattr(self, name) is not None:
+        np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+  def load_alias_tables(self, path, mmap_mode="r"):
+    '''
+    Loads alias arrays written by save_alias_tables instead of running
+    preprocess_transition_probs. The arrays are memory-mapped by default.
+    '''
+    for name in ALIAS_ARRAYS:
+      array_path = os.path.join(path, name + ".npy")
+      setattr(self, name, np.load(array_path, mmap_mode=mmap_mode) if os.path.isfile(array_path) else None)
+    self.alias_path = path if mmap_mode is not None else None
+
+  def alias_tables_path(self, graph_path, alias_dir=None):
+    '''
+    Where the alias tables for this graph and p, q are persisted: under
+    alias_dir if given, otherwise in a <graph_path>.alias directory next to the
+    graph file at graph_path.
+    '''
+    if alias_dir is None:
+      alias_dir = graph_path + ".alias"
+    return os.path.join(alias_dir, "%s_%s_%s" % (self.G.fingerprint(), self.p, self.q))
+
+  def preprocess_transition_probs_persisted(self, graph_path, update_from=None, alias_dir=None):
+    '''
+    Memory-maps the alias tables persisted at alias_tables_path, building and
+    saving them with preprocess_transition_probs first if there are none for
+    this graph and p, q yet. If update_from holds the (previous, old_of_new,
+    changed) arguments of update_transition_probs, they are built with that
+    instead. When another process saves the same tables first, its tables are
+    used and ours are dropped.
+    '''
+    path = self.alias_tables_path(graph_path, alias_dir)
+    if os.path.isdir(path):
+      print("Loading alias tables from %s" % path)
+    else:
+      if update_from is not None:
+        self.update_transition_probs(*update_from)
+      else:
+        self.preprocess_transition_probs()
+      scratch = "%s.tmp%d" % (path, os.getpid())
+      self.save_alias_tables(scratch)
+      try:
+        os.replace(scratch, path)
+      except OSError:
+        # Another process finished the same tables first, they are identical
+        shutil.rmtree(scratch, ignore_errors=True)
+        if not os.path.isdir(path):
+          raise
+        print("Loading alias tables saved concurrently to %s" % path)
+    self.load_alias_tables(path)
+
+  def __getstate__(self):
+    # Memory-mapped alias tables are pickled as their path, the receiving process maps them again
+    state = dict(self.__dict__)
+    if self.alias_path is not None:
+      for name in ALIAS_ARRAYS:
+        state.pop(name, None)
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    if self.alias_path is not None:
+      self.load_alias_tables(self.alias_path)
+
+  def _second_order_codes(self, max_entries_per_batch, edges=None):
+    '''
+    Yields batches of (edges, codes, bounds). For the edge src -> dst at
+    edges[i], codes[bounds[i]:bounds[i + 1]] classifies every neighbor x of dst:
+    0 if x is src (weight 1/p), 1 if there is an edge x -> src (weight 1) and 2
+    otherwise (weight 1/q). edges restricts the batches to these CSR offsets,
+    by default all edges are covered.
+    '''
+    G = self.G
+    num_nodes = G.number_of_nodes()
+    degrees = np.diff(G.indptr)
+    sources = np.repeat(np.arange(num_nodes, dtype=np.int64), degrees)
+    # Row-major CSR order makes these keys sorted, so edge lookups are a binary search
+    edge_keys = sources * num_nodes + G.indices
+    all_edges = np.arange(len(edge_keys)) if edges is None else np.asarray(edges, dtype=np.int64)
+    table_sizes = np.cumsum(degrees[G.indices[all_edges]])
+
+    lo = 0
+    while lo < len(all_edges):
+      done = table_sizes[lo - 1] if lo > 0 else 0
+      hi = max(lo + 1, int(np.searchsorted(table_sizes, done + max_entries_per_batch, side="right")))
+      edges = all_edges[lo:hi]
+      dst = G.indices[edges]
+      counts = degrees[dst]
+      bounds = np.zeros(len(edges) + 1, dtype=np.int64)
+      np.cumsum(counts, out=bounds[1:])
+
+      within = np.arange(bounds[-1]) - np.repeat(bounds[:-1], counts)
+      nbrs = G.indices[np.repeat(G.indptr[dst], counts) + within].astype(np.int64)
+      src = np.repeat(sources[edges], counts)
+
+      reverse_keys = nbrs * num_nodes + src
+      pos = np.minimum(np.searchsorted(edge_keys, reverse_keys), len(edge_keys) - 1)
+      codes = np.where(edge_keys[pos] == reverse_keys, 1, 2).astype(np.uint8)
+      codes[nbrs == src] = 0
+      yield edges, codes, bounds.tolist()
+      lo = hi
+
+
+ALIAS_ARRAYS = ["alias_J", "alias_q", "node_alias_start", "edge_alias_start"]
+
+
+class AliasPool():
+  '''
+  Collects alias tables into the flat alias_J and alias_q arrays, storing tables
+  with the same key once. A pool can extend the arrays of an existing pool, whose
+  offsets stay valid.
+  '''
+  def __init__(self, base_J=None, base_q=None):
+    self.keys = {}
+    self.tables = [] if base_J is None else [(base_J, base_q)]
+    self.size = 0 if base_J is None else len(base_J)
+
+  def offset(self, key, probs):
+    '''
+    Returns the pool offset of the table for key, building it from probs(), a
+    callable returning the normalized probabilities, the first time key is seen.
+    '''
+    offset = self.keys.get(key)
+    if offset is None:
+      offset = self.keys[key] = self.size
+      self.tables.append(alias_setup(probs()))
+      self.size += len(self.tables[-1][0])
+    return offset
+
+  def uniform(self, degree):
+    return self.offset((-1, degree), lambda: [1.0 / degree] * degree)
+
+  def arrays(self):
+    if not self.tables:
+      return np.zeros(0, dtype=np.int32), np.zeros(0)
+    return np.concatenate([J for J, _ in self.tables]).astype(np.int32), np.concatenate([q for _, q in self.tables])
+
+
+def diff_graphs(old_G, new_G):
+  '''
+  Compares two CSRGraphs by node and relation names. Returns old_of_new, the id
+  in old_G of every node of new_G or -1 for new nodes, and changed, a mask over
+  the nodes of new_G that are new or whose out-edges or their relations differ.
+  '''
+  old_of_new = np.fromiter((old_G.node_ids.get(name, -1) for name in new_G.node_names), dtype=np.int64,
+                           count=new_G.number_of_nodes())
+  old_relations = {name: i for i, name in enumerate(old_G.relation_names)}
+  old_relation_of_new = np.array([old_relations.get(name, -1) for name in new_G.relation_names] + [-1], dtype=np.int64)
+
+  degrees = np.diff(new_G.indptr)
+  old_degrees = np.diff(old_G.indptr)
+  changed = (old_of_new < 0) | (degrees != old_degrees[np.maximum(old_of_new, 0)])
+
+  sources = np.repeat(np.arange(new_G.number_of_nodes()), degrees)
+  old_edges = old_G.edge_indices(old_of_new[sources], old_of_new[new_G.indices])
+  same = old_edges >= 0
+  same[same] = old_G.edge_types[old_edges[same]] == old_relation_of_new[new_G.edge_types[same]]
+  changed[sources[~same]] = True
+  return old_of_new, changed
+
+
+def affected_nodes(G, changed, second_order):
+  '''
+  Nodes of G whose transition probabilities differ from the old graph given the
+  changed mask of diff_graphs. With second order walks (p or q not 1), the
+  probabilities at a node also depend on which of its neighbors link back, so
+  nodes linking to a changed node are affected as well.
+  '''
+  affected = changed.copy()
+  if second_order:
+    sources = np.repeat(np.arange(G.number_of_nodes()), np.diff(G.indptr))
+    affected[sources[changed[G.indices]]] = True
+  return affected
+
+# The Graph that walk worker processes sample from, see walk_pool
+_walk_graph = None
+
+
+def _init_walk_worker(graph):
+  global _walk_graph
+  _walk_graph = graph
+
+
+@contextmanager
+def walk_pool(graph, workers):
+  '''
+  Opens a process pool whose workers can read graph through worker_graph().
+  With the fork start method the workers inherit the graph and its alias arrays
+  instead of receiving a pickled copy, elsewhere it is sent once per worker.
+  '''
+  global _walk_graph
+  if "fork" in multiprocessing.get_all_start_methods():
+    _walk_graph = graph
+    try:
+      with multiprocessing.get_context("fork").Pool(workers) as pool:
+        yield pool
+    finally:
+      _walk_graph = None
+  else:
+    with multiprocessing.Pool(workers, initializer=_init_walk_worker, initargs=(graph,)) as pool:
+      yield pool
+
+
+def worker_graph():
+  return _walk_graph
+
+
+def _simulate_shard(task, batch_size=8192):
+  '''
+  Walks once from every start node of the shard with Graph.walk_batch. Returns
+  the walks as one flat int32 token array plus the offsets where each walk begins.
+  '''
+  start_nodes, walk_length, seed, first_relations = task
+  rng = np.random.default_rng(seed)
+  tokens, bounds = [], [np.zeros(1, dtype=np.int64)]
+  for first in range(0, len(start_nodes), batch_size):
+    batch_tokens, batch_bounds = _walk_graph.walk_batch(start_nodes[first:first + batch_size], walk_length, rng,
+                                                        first_relations=_slice(first_relations, first,
+                                                                               first + batch_size))
+    tokens.append(batch_tokens)
+    bounds.append(batch_bounds[1:] + bounds[-1][-1])
+  return np.concatenate(tokens), np.concatenate(bounds)
+
+
+def _slice(array, first, last):
+  return None if array is None else array[first:last]
+
+
+def _segments(starts, lengths):
+  '''
+  Concatenates the index ranges starts[i]:starts[i] + lengths[i].
+  '''
+  lengths = np.asarray(lengths, dtype=np.int64)
+  offsets = np.cumsum(lengths) - lengths
+  return np.repeat(np.asarray(starts, dtype=np.int64) - offsets, lengths) + np.arange(lengths.sum())
+
+
+def normalize(unnormalized_probs):
+  norm_const = sum(unnormalized_probs)
+  return [float(u_prob) / norm_const for u_prob in unnormalized_probs]
+
 
 def alias_setup(probs):
   '''
@@ -157,7 +980,7 @@ def alias_setup(probs):
   '''
   K = len(probs)
   q = np.zeros(K)
-  J = np.zeros(K, dtype=np.int)
+  J = np.zeros(K, dtype=int)
 
   smaller = []
   larger = []
@@ -182,99 +1005,206 @@ def alias_setup(probs):
   return J, q
 
 
-def alias_draw(J, q):
+def alias_draw(J, q, rng=None):
   '''
   Draw sample from a non-uniform discrete distribution using alias sampling.
+  Uses rng, a numpy Generator, if given and the global np.random state otherwise.
   '''
   K = len(J)
+  rand = np.random.rand if rng is None else rng.random
 
-  kk = int(np.floor(np.random.rand() * K))
-  if np.random.rand() < q[kk]:
+  kk = int(np.floor(rand() * K))
+  if rand() < q[kk]:
     return kk
   else:
     return J[kk]
 
 
-"""
-  parser.add_argument('--walk-length', type=int, default=80,
-                      help='Length of walk per source. Default is 80.')
+def generate_random_walks_from_assertions(path, output_folder, p=1.0, q=1.0, num_walks=2, walk_length=15, workers=1,
+                                          seed=None, batch_size=None, output_format="binary", persist_alias_tables=True,
+                                          schedule=None, dead_end_walks=0, relation_quota=None, previous_walks=None,
+                                          alias_tables_dir=None):
+  '''
+  p is the return hyperparameter, q the inout hyperparameter, num_walks the number
+  of random walks per source and walk_length the length of a walk in tokens.
+  With workers > 1 the walks are simulated in parallel, seeded with seed. With a
+  batch_size, a single process advances batch_size walks at a time.
+  The walks are written as a walk store (see walk_store.py), or pickled as a list
+  of lists with output_format="pickle". With persist_alias_tables, the alias
+  tables are saved in alias_tables_dir, by default a <path>.alias directory next
+  to path, and reused by later runs with the same graph, p and q.
+  With a schedule strategy ("uniform", "degree" or "relation", see
+  walk_scheduler.py) the start nodes are scheduled instead of walking num_walks
+  times from every node, and the schedule report is printed and kept in the meta.
+
+  previous_walks names a walk store written by an earlier run with the same
+  settings on an older version of the graph at path, for example before a
+  relation was added. The walks are then updated incrementally: the graphs are
+  diffed, alias tables are only rebuilt where they changed and only walks
+  through affected nodes are resampled, see Graph.iter_updated_walk_batches.
+  '''
+  is_directed = True  # whether the graph is directed
+
+  csr_G = read_graph(path=path)
+  G = Graph(csr_G, is_directed, p, q)
+
+  previous = None
+  update_from = None
+  if previous_walks is not None:
+    previous, old_of_new, changed = _load_previous_walks(previous_walks, p, q, num_walks, walk_length, csr_G)
+    update_from = _previous_alias_tables(previous, previous_walks, old_of_new, changed, is_directed, p, q)
+    print("%d of %d nodes changed" % (changed.sum(), len(changed)))
 
-  parser.add_argument('--num-walks', type=int, default=10,
-                      help='Number of walks per source. Default is 10.')
+  if persist_alias_tables:
+    G.preprocess_transition_probs_persisted(path, update_from, alias_tables_dir)
+  elif update_from is not None:
+    G.update_transition_probs(*update_from)
+  else:
+    G.preprocess_transition_probs()
 
-  parser.add_argument('--workers', type=int, default=8,
-                      help='Number of parallel workers. Default is 8.')
+  meta = {"graph": path, "p": p, "q": q, "walks_per_node": num_walks, "walk_length": walk_length, "workers": workers,
+          "seed": seed, "alias_tables": G.alias_path}
+  if previous is not None:
+    batches = _incremental_walk_batches(G, previous, previous_walks, old_of_new, changed, seed, batch_size, meta)
+  elif schedule is not None:
+    batches = _scheduled_walk_batches(G, num_walks, walk_length, workers, seed, batch_size, schedule, dead_end_walks,
+                                      relation_quota, meta)
+  elif workers > 1:
+    batches = G.iter_walk_batches_parallel(num_walks, walk_length, workers=workers, seed=seed,
+                                           batch_size=batch_size or 8192)
+  elif batch_size:
+    batches = G.iter_walk_batches(num_walks, walk_length, seed=seed, batch_size=batch_size)
+  else:
+    # simulate_walks, which produces walks as lists of names
+    batches = None
 
-  parser.add_argument('--p', type=float, default=1,
-                      help='Return hyperparameter. Default is 1.')
+  filename = output_folder + "/random_walk_" + str(p) + "_" + str(q) + "_" + str(num_walks) + "_" + str(walk_length)
+  if output_format == "pickle":
+    walks = G.simulate_walks(num_walks, walk_length) if batches is None else G.decode_walk_batches(batches)
+    filename += ".p"
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    with open(filename, 'wb') as handle:
+      pickle.dump(walks, handle)
+    print(len(walks))
+  else:
+    filename += ".walks"
+    num_walks_written = _write_walk_store(G, filename, batches, num_walks, walk_length, meta)
+    if previous is not None:
+      print(json.dumps(meta["incremental"], indent=2))
+    print(num_walks_written)
+  return filename
 
-  parser.add_argument('--q', type=float, default=1,
-                      help='Inout hyperparameter. Default is 1.')
 
-"""
+def _previous_alias_tables(previous, previous_walks, old_of_new, changed, is_directed, p, q):
+  '''
+  The (previous, old_of_new, changed) arguments of Graph.update_transition_probs
+  for an incremental update, or None if the alias tables of the earlier run are
+  gone and have to be built from scratch.
+  '''
+  old_tables = previous.meta.get("alias_tables")
+  if not old_tables or not os.path.isdir(old_tables):
+    return None
+  old_graph = Graph(CSRGraph.load(os.path.join(previous_walks, "graph")), is_directed, p, q)
+  old_graph.load_alias_tables(old_tables)
+  return old_graph, old_of_new, changed
 
-def generate_random_walks_from_assertions(path, output_folder):
-  p = 1.0  # return hyperparameter
-  q = 1.0  # inout hyperparameter
-  is_directed = True  # whether the graph is directed
-  num_walks = 2  # number of wandom walks per source def. 10
-  walk_length = 15  # length of walk per source def. 80
-
-  nx_G = read_graph(path=path)
-  G = Graph(nx_G, is_directed, p, q)
-  G.preprocess_transition_probs()
-  walks = G.simulate_walks(num_walks, walk_length)
-  filename = output_folder + "/random_walk_" + str(p) + "_" + str(q) + "_" + str(num_walks) + "_" + str(walk_length) + ".p"
-  os.makedirs(os.path.dirname(filename), exist_ok=True)
-  with open(filename, 'wb') as handle:
-    pickle.dump(walks, handle)
-  print(len(walks))
-
-
-def analyze_graph(path):
-  nx_G = read_graph(path=path)
-  print("%d nodes in the graph" % nx_G.number_of_nodes())
-  print("%d edges in the graph" % nx_G.number_of_edges())
-  print("%f density of graph" % nx.density(nx_G))
-  #print("%f density of graph" % nx.number_of_selfloops(nx_G))
-  print("%s" % nx.info(nx_G))
-  print("%f avg in-degree" % float(float(sum(nx_G.in_degree().values()))/float(len(nx_G.in_degree().values()))))
-  print("%f min in-degree" % float(float(min(nx_G.in_degree().values()))))
-  print("%f max in-degree" % float(float(max(nx_G.in_degree().values()))))
-  print("%f std in-degree" % float(float(np.std(np.array([float(v) for v in nx_G.in_degree().values()], dtype=np.float)))))
-  print("%f avg in-degree" % float(float(np.average(np.array([float(v) for v in nx_G.in_degree().values()], dtype=np.float)))))
-
-  print("%f avg out-degree" % float(float(sum(nx_G.out_degree().values()))/float(len(nx_G.out_degree().values()))))
-  print("%f min out-degree" % float(float(min(nx_G.out_degree().values()))))
-  print("%f max out-degree" % float(float(max(nx_G.out_degree().values()))))
-  print("%f std out-degree" % float(float(np.std(np.array([float(v) for v in nx_G.out_degree().values()], dtype=np.float)))))
-  print("%f avg out-degree" % float(float(np.average(np.array([float(v) for v in nx_G.out_degree().values()], dtype=np.float)))))
-
-
-  comps_strong = list(nx.strongly_connected_component_subgraphs(nx_G))
-  print("%d num strongly connected components" % len(comps_strong))
-  comps_weak = list(nx.weakly_connected_component_subgraphs(nx_G))
-  print("%d num weakly connected components" % len(comps_weak))
-  diameters=[]
-  for c in comps_strong:
-    diameters.append(nx.diameter(c))
-  print("Avg diameter %f for strongly connected components" % float(sum(diameters)/len(diameters)))
-  print("Max diameter %f for strongly connected components" % max(diameters))
-  print("Min diameter %f for strongly connected components" % min(diameters))
-  print("%f std diameter" % float(float(np.std(np.array(diameters, dtype=np.float)))))
-  print("%f avg diameter" % float(float(np.average(np.array(diameters, dtype=np.float)))))
+
+def _incremental_walk_batches(G, previous, previous_walks, old_of_new, changed, seed, batch_size, meta):
+  '''
+  Yields the walks of the earlier run in previous, resampling those through
+  nodes affected by the graph changes. The update statistics are collected in
+  meta as they are produced.
+  '''
+  update_stats = {}
+  meta.update(incremental_from=previous_walks, incremental=update_stats)
+  affected = affected_nodes(G.G, changed, second_order=G.edge_alias_start is not None)
+  return G.iter_updated_walk_batches(previous, old_of_new, affected, seed, batch_size or 8192, update_stats)
+
+
+def _scheduled_walk_batches(G, num_walks, walk_length, workers, seed, batch_size, schedule, dead_end_walks,
+                            relation_quota, meta):
+  '''
+  Yields the walks from the start nodes walk_scheduler.schedule_start_nodes
+  picks with the given strategy, and prints the schedule report and keeps it in
+  meta.
+  '''
+  start_nodes, first_relations, report = schedule_start_nodes(G.G, num_walks, schedule, dead_end_walks,
+                                                              relation_quota, seed)
+  print(json.dumps(report, indent=2))
+  meta["schedule"] = report
+  return G.iter_scheduled_walk_batches(start_nodes, walk_length, seed, batch_size or 8192, workers, first_relations)
+
+
+def _write_walk_store(G, filename, batches, num_walks, walk_length, meta):
+  '''
+  Writes (tokens, bounds) batches, or simulate_walks if batches is None, as a
+  walk store to filename, together with the graph, and returns the number of
+  walks written.
+  '''
+  csr_G = G.G
+  # Written next to the output first, an incremental update may replace the store it reads
+  scratch = "%s.tmp%d" % (filename, os.getpid())
+  try:
+    with WalkStoreWriter(scratch, csr_G.node_names, csr_G.relation_names, meta=meta) as writer:
+      if batches is None:
+        relation_ids = {name: i for i, name in enumerate(csr_G.relation_names)}
+        writer.append_walks(G.simulate_walks(num_walks, walk_length), csr_G.node_ids, relation_ids)
+      else:
+        for tokens, bounds in batches:
+          writer.append(tokens, bounds)
+  except BaseException:
+    shutil.rmtree(scratch, ignore_errors=True)
+    raise
+  # The graph is kept with the walks, so a later run can update them incrementally
+  csr_G.save(os.path.join(scratch, "graph"))
+  shutil.rmtree(filename, ignore_errors=True)
+  os.rename(scratch, filename)
+  return writer.num_walks
+
+
+def _load_previous_walks(previous_walks, p, q, num_walks, walk_length, csr_G):
+  '''
+  Opens the walk store of an earlier run for an incremental update and diffs
+  the graph it was sampled from against csr_G.
+  '''
+  if not os.path.isdir(os.path.join(previous_walks, "graph")):
+    raise ValueError("%s is not a walk store with its graph, it can not be updated incrementally" % previous_walks)
+  previous = WalkStore(previous_walks)
+  settings = {"p": p, "q": q, "walks_per_node": num_walks, "walk_length": walk_length}
+  mismatched = {key: previous.meta.get(key) for key, value in settings.items() if previous.meta.get(key) != value}
+  if mismatched or "schedule" in previous.meta:
+    raise ValueError("%s was sampled with different settings %s, it can not be updated incrementally"
+                     % (previous_walks, dict(mismatched, schedule=previous.meta.get("schedule"))))
+  old_of_new, changed = diff_graphs(CSRGraph.load(os.path.join(previous_walks, "graph")), csr_G)
+  return previous, old_of_new, changed
+
+
+def analyze_graph(path, output_path=None, diameter_time_budget=60.0):
+  '''
+  Prints node, edge, degree, component and diameter statistics of the graph as
+  JSON, see graph_stats.py, and writes them to output_path if given.
+  '''
+  G = read_graph(path=path)
+  stats = graph_statistics(G, diameter_time_budget=diameter_time_budget)
+  print(json.dumps(stats, indent=2))
+  if output_path:
+    with open(output_path, "w") as out:
+      json.dump(stats, out, indent=2)
+  return stats
 
 
 def load_random_walk(p):
-  walk = pickle.load(open(p, 'rb'))
-  return walk
+  '''
+  Loads walks from a walk store or a pickle file, see walk_store.load_walks.
+  '''
+  return load_walks(p)
 
 def main():
   path = "../data/concept_net/cn_assertions_filtered.txt" #Specify the path to the preprocessed relation file (from preprocess_cn.py).
   generate_random_walks_from_assertions(path=path, output_folder="../data/concept_net/")
 
   #analyze_graph(path)
-  #load_random_walk(p="./randomwalks/random_walk_1.0_1.0_2_10.p")
+  #load_random_walk(p="./randomwalks/random_walk_1.0_1.0_2_10.walks")
 
 if __name__=="__main__":
   main()
@@ -0,0 +1,162 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+from contextlib import contextmanager
+
+# Content-addressed cache for the stages of the random walk pipeline.
+#
+# Every stage output is a directory stored under <root>/<stage>/<key>, where the
+# key hashes the stage name, its parameters and its inputs. Inputs are either
+# files, hashed by content, or the keys of upstream stages, so changing anything
+# upstream changes every key below it. Entries are evicted least recently used
+# first once the cache grows past max_bytes.
+
+_USED_STAMP = ".last_used"
+
+
+class StageCache():
+  def __init__(self, root, max_bytes=None):
+    self.root = root
+    self.max_bytes = max_bytes
+    os.makedirs(root, exist_ok=True)
+    self._file_hashes_path = os.path.join(root, "file_hashes.json")
+    self._file_hashes = self._load_file_hashes()
+    self._file_hashes_changed = False
+
+  def _load_file_hashes(self):
+    '''
+    Reads the remembered digests, keeping only the files that still have the
+    size and modification time they were hashed at.
+    '''
+    if not os.path.isfile(self._file_hashes_path):
+      return {}
+    with open(self._file_hashes_path) as f:
+      remembered = json.load(f)
+    file_hashes = {}
+    for path, entry in remembered.items():
+      if not isinstance(entry, dict) or not os.path.isfile(path):
+        continue
+      stat = os.stat(path)
+      if [entry["size"], entry["mtime_ns"]] == [stat.st_size, stat.st_mtime_ns]:
+        file_hashes[path] = entry
+    return file_hashes
+
+  def file_digest(self, path):
+    '''
+    Returns the sha256 of a file's content. Digests are remembered by path, size
+    and modification time, so unchanged files are only read once. Call flush to
+    keep them for later runs.
+    '''
+    stat = os.stat(path)
+    path = os.path.abspath(path)
+    entry = self._file_hashes.get(path)
+    if entry is None or [entry["size"], entry["mtime_ns"]] != [stat.st_size, stat.st_mtime_ns]:
+      digest = hashlib.sha256()
+      with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+          digest.update(block)
+      entry = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+      self._file_hashes[path] = entry
+      self._file_hashes_changed = True
+    return entry["sha256"]
+
+  def flush(self):
+    '''
+    Writes the remembered digests to file_hashes.json, if any changed.
+    '''
+    if not self._file_hashes_changed:
+      return
+    scratch = "%s.tmp%d" % (self._file_hashes_path, os.getpid())
+    with open(scratch, "w") as out:
+      json.dump(self._file_hashes, out)
+    os.replace(scratch, self._file_hashes_path)
+    self._file_hashes_changed = False
+
+  def key(self, stage, params, input_files=(), upstream_keys=()):
+    '''
+    Hashes a stage, its JSON-serializable params, the content of input_files and
+    the keys of the upstream stages it reads from.
+    '''
+    digest = hashlib.sha256()
+    digest.update(json.dumps([stage, params], sort_keys=True).encode("utf8"))
+    for path in input_files:
+      digest.update(self.file_digest(path).encode("utf8"))
+    for upstream_key in upstream_keys:
+      digest.update(upstream_key.encode("utf8"))
+    return digest.hexdigest()[:32]
+
+  def path(self, stage, key):
+    return os.path.join(self.root, stage, key)
+
+  def lookup(self, stage, key):
+    '''
+    Returns the directory of a cached stage output, or None on a miss.
+    '''
+    path = self.path(stage, key)
+    if not os.path.isdir(path):
+      return None
+    self._touch(path)
+    return path
+
+  @contextmanager
+  def store(self, stage, key):
+    '''
+    Yields a scratch directory to write a stage output to. It becomes the cache
+    entry for key only if the block finishes without an exception, so a crashed
+    run never leaves a partial entry behind.
+    '''
+    path = self.path(stage, key)
+    scratch = "%s.tmp%d" % (path, os.getpid())
+    shutil.rmtree(scratch, ignore_errors=True)
+    os.makedirs(scratch)
+    try:
+      yield scratch
+    except BaseException:
+      shutil.rmtree(scratch, ignore_errors=True)
+      raise
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(scratch, path)
+    self._touch(path)
+    self.evict(keep=[path])
+
+  def _touch(self, path):
+    with open(os.path.join(path, _USED_STAMP), "w") as out:
+      out.write(str(time.time()))
+
+  def entries(self):
+    '''
+    Lists (last_used, size_in_bytes, path) for every cache entry.
+    '''
+    entries = []
+    for stage in os.listdir(self.root):
+      stage_dir = os.path.join(self.root, stage)
+      if not os.path.isdir(stage_dir):
+        continue
+      for key in os.listdir(stage_dir):
+        path = os.path.join(stage_dir, key)
+        stamp = os.path.join(path, _USED_STAMP)
+        if not os.path.isfile(stamp):
+          continue
+        size = sum(os.path.getsize(os.path.join(d, name)) for d, _, names in os.walk(path) for name in names)
+        entries.append((os.path.getmtime(stamp), size, path))
+    return entries
+
+  def evict(self, keep=()):
+    '''
+    Removes the least recently used entries until the cache fits in max_bytes.
+    Entries in keep are never removed.
+    '''
+    if self.max_bytes is None:
+      return
+    entries = sorted(self.entries())
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+      if total <= self.max_bytes:
+        break
+      if path in keep:
+        continue
+      print("Evicting %s from the stage cache" % path)
+      shutil.rmtree(path, ignore_errors=True)
+      total -= size
@@ -0,0 +1,144 @@
+import json
+import os
+import numpy as np
+
+# Compact on-disk format for tokenized corpora.
+#
+# A token store is a directory holding
+#   input_ids.bin  token ids of all sequences back to back, uint16 if the
+#                  vocabulary fits, int32 otherwise
+#   offsets.bin    int64 offsets, sequence i is input_ids[offsets[i]:offsets[i + 1]]
+#   meta.json      format version, dtype, counts, the tokenizer and how the
+#                  sequences were made
+# Both .bin files are raw little-endian arrays that np.memmap opens directly.
+#
+# This module only needs numpy, so both the random walk scripts and run_mlm.py
+# can import it.
+
+FORMAT_VERSION = 1
+
+
+def token_dtype(vocab_size):
+  return "<u2" if vocab_size <= 1 << 16 else "<i4"
+
+
+class TokenStoreWriter():
+  '''
+  Appends tokenized sequences to a new token store. Use as a context manager,
+  the store is complete once the writer is closed.
+  '''
+  def __init__(self, path, vocab_size, meta=None):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.dtype = token_dtype(vocab_size)
+    self.meta = dict(meta or {}, vocab_size=vocab_size)
+    self.num_sequences = 0
+    self.num_tokens = 0
+    self.input_ids = open(os.path.join(path, "input_ids.bin"), "wb")
+    self.offsets = open(os.path.join(path, "offsets.bin"), "wb")
+    self.offsets.write(np.zeros(1, dtype="<i8").tobytes())
+
+  def append(self, input_ids, bounds):
+    '''
+    Appends sequences given as a flat id array plus the offsets where each
+    sequence begins.
+    '''
+    bounds = np.asarray(bounds, dtype=np.int64)
+    self.input_ids.write(np.asarray(input_ids).astype(self.dtype).tobytes())
+    self.offsets.write((bounds[1:] - bounds[0] + self.num_tokens).astype("<i8").tobytes())
+    self.num_sequences += len(bounds) - 1
+    self.num_tokens += int(bounds[-1] - bounds[0])
+
+  def append_sequences(self, sequences):
+    bounds = np.zeros(len(sequences) + 1, dtype=np.int64)
+    np.cumsum([len(ids) for ids in sequences], out=bounds[1:])
+    self.append(np.fromiter((i for ids in sequences for i in ids), dtype=np.int64, count=bounds[-1]), bounds)
+
+  def close(self):
+    self.input_ids.close()
+    self.offsets.close()
+    meta = dict(self.meta, format_version=FORMAT_VERSION, dtype=self.dtype, num_sequences=self.num_sequences,
+                num_tokens=self.num_tokens)
+    with open(os.path.join(self.path, "meta.json"), "w") as out:
+      json.dump(meta, out, indent=2)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class TokenStore():
+  '''
+  Read-only view of a token store with memory-mapped arrays. Indexing returns
+  the ids of a sequence as a numpy array.
+  '''
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json")) as f:
+      self.meta = json.load(f)
+    if self.meta["format_version"] != FORMAT_VERSION:
+      raise ValueError("Unsupported token store version %s in %s" % (self.meta["format_version"], path))
+    self.path = path
+    self.input_ids = np.memmap(os.path.join(path, "input_ids.bin"), dtype=self.meta["dtype"], mode="r",
+                               shape=(self.meta["num_tokens"],)) \
+      if self.meta["num_tokens"] else np.zeros(0, dtype=self.meta["dtype"])
+    self.offsets = np.memmap(os.path.join(path, "offsets.bin"), dtype="<i8", mode="r",
+                             shape=(self.meta["num_sequences"] + 1,))
+
+  def __len__(self):
+    return self.meta["num_sequences"]
+
+  def lengths(self):
+    return np.diff(self.offsets)
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    return self.input_ids[self.offsets[i]:self.offsets[i + 1]]
+
+
+def is_token_store(path):
+  return os.path.isfile(os.path.join(path, "meta.json")) and os.path.isfile(os.path.join(path, "input_ids.bin"))
+
+
+class CachedLineTokenizer():
+  '''
+  Tokenizes lines of a corpus with a small vocabulary of words, like the walk
+  corpora, by tokenizing every distinct whitespace separated word once and
+  concatenating the cached ids. Byte-level BPE tokenizers encode a word
+  differently at the start of a line and after a space, so both variants are
+  cached. verify checks the result against tokenizing whole lines.
+  '''
+  def __init__(self, tokenizer):
+    self.tokenizer = tokenizer
+    self.line_start = {}
+    self.after_space = {}
+
+  def _word(self, word, first):
+    cache = self.line_start if first else self.after_space
+    ids = cache.get(word)
+    if ids is None:
+      ids = cache[word] = self.tokenizer(word if first else " " + word, add_special_tokens=False)["input_ids"]
+    return ids
+
+  def encode(self, line):
+    ids = []
+    words = line.rstrip()
+    for i, word in enumerate(words.split()):
+      ids.extend(self._word(word, i == 0))
+    if len(words) < len(line):
+      # trailing whitespace, which byte-level BPE keeps as a token of its own
+      ids.extend(self._word(line[len(words):], True))
+    return ids
+
+  def verify(self, lines):
+    '''
+    Raises ValueError if the cached encoding of any of lines differs from the
+    tokenizer's own.
+    '''
+    for line in lines:
+      expected = self.tokenizer(line, add_special_tokens=False)["input_ids"]
+      if self.encode(line) != expected:
+        raise ValueError("Word by word tokenization of %r differs from tokenizing the line, this tokenizer can not "
+                         "be used to pretokenize the corpus" % line)
@@ -0,0 +1,155 @@
+import numpy as np
+from preprocess_cn import LAMA_dict, default_dict
+
+# Decides how many walks start from each node. simulate_walks starts num_walks
+# walks from every node, including sinks, whose walks are a single token and
+# never become a training sentence. The strategies here skip or down-weight those
+# dead ends and can spend the walks by out-degree or by relation instead. Walks
+# scheduled for a relation take their first hop along an edge of that relation.
+
+STRATEGIES = ["uniform", "degree", "relation"]
+
+
+def allocate(total, weights):
+  '''
+  Splits total walks proportionally to weights with the largest remainder
+  method, so the counts add up to total exactly.
+  '''
+  weights = np.asarray(weights, dtype=np.float64)
+  if total <= 0 or weights.sum() <= 0:
+    return np.zeros(len(weights), dtype=np.int64)
+  exact = total * weights / weights.sum()
+  counts = np.floor(exact).astype(np.int64)
+  remainder = int(total - counts.sum())
+  if remainder > 0:
+    counts[np.argsort(counts - exact, kind="stable")[:remainder]] += 1
+  return counts
+
+
+def relation_edge_counts(G, relation):
+  '''
+  Number of out-edges of every node that have the given relation id.
+  '''
+  sources = np.repeat(np.arange(G.number_of_nodes()), np.diff(G.indptr))
+  return np.bincount(sources[G.edge_types == relation], minlength=G.number_of_nodes())
+
+
+def relation_ids_of_quota(G, relation_quota):
+  '''
+  Maps the relations of relation_quota to relation ids of G. Relations are
+  named as in the graph, in natural language ("is a"), or as in the ConceptNet
+  relation files ("isA"). Raises a ValueError for relations that are not in
+  the graph or are given twice.
+  '''
+  relation_dict = dict(default_dict, **LAMA_dict)
+  relation_ids = {name: i for i, name in enumerate(G.relation_names)}
+  quota = {}
+  unknown = []
+  for relation, weight in relation_quota.items():
+    name = relation if relation in relation_ids else relation_dict.get(relation)
+    if name not in relation_ids:
+      unknown.append(relation)
+    elif relation_ids[name] in quota:
+      raise ValueError("Relation %s is given twice in the relation quota" % name)
+    else:
+      quota[relation_ids[name]] = weight
+  if unknown:
+    raise ValueError("Relations %s are not in the graph, which has %s" % (unknown, G.relation_names))
+  return quota
+
+
+def relation_walks_per_node(G, num_walks, relation_quota=None):
+  '''
+  Splits num_walks walks per node with out-edges between relations by
+  relation_quota, a dict of relation name to weight (all relations of the graph
+  equally if None, see relation_ids_of_quota for the names), then within a
+  relation proportionally to every node's edges of it. Returns a dict of
+  relation id to the walks per node.
+  '''
+  alive = np.diff(G.indptr) > 0
+  budget = num_walks * int(alive.sum())
+  if relation_quota is None:
+    relation_quota = {name: 1.0 for name in G.relation_names}
+  quota = relation_ids_of_quota(G, relation_quota)
+  relations = list(quota)
+  shares = allocate(budget, [quota[relation] for relation in relations])
+  return {relation: allocate(share, relation_edge_counts(G, relation))
+          for relation, share in zip(relations, shares.tolist())}
+
+
+def walks_per_node(G, num_walks, strategy="uniform", dead_end_walks=0, relation_quota=None):
+  '''
+  Returns how many walks to start from every node. All strategies spend
+  num_walks walks per node that has out-edges in total:
+    uniform   num_walks from every node with out-edges
+    degree    proportionally to the out-degree
+    relation  split between relations by relation_quota, see
+              relation_walks_per_node
+  Dead-end nodes get dead_end_walks walks each, 0 skips them.
+  '''
+  degrees = np.diff(G.indptr)
+  alive = degrees > 0
+  budget = num_walks * int(alive.sum())
+
+  if strategy == "uniform":
+    counts = np.where(alive, num_walks, 0)
+  elif strategy == "degree":
+    counts = allocate(budget, degrees)
+  elif strategy == "relation":
+    counts = np.zeros(G.number_of_nodes(), dtype=np.int64)
+    for relation_counts in relation_walks_per_node(G, num_walks, relation_quota).values():
+      counts += relation_counts
+  else:
+    raise ValueError("Unknown schedule strategy %s, expected one of %s" % (strategy, STRATEGIES))
+
+  return np.where(alive, counts, dead_end_walks).astype(np.int64)
+
+
+def schedule_start_nodes(G, num_walks, strategy="uniform", dead_end_walks=0, relation_quota=None, seed=None):
+  '''
+  Returns the start node of every walk, shuffled, the relation id each walk's
+  first hop has to take (None unless strategy is relation, -1 for walks from
+  dead ends) and a report of the schedule: the number of walks, how many dead
+  ends were skipped or walked from, and the expected share of each relation
+  among the first hops of the walks.
+  '''
+  num_nodes = G.number_of_nodes()
+  degrees = np.diff(G.indptr)
+  alive = degrees > 0
+  rng = np.random.default_rng(seed)
+  first_hops = {}
+
+  if strategy == "relation":
+    per_relation = relation_walks_per_node(G, num_walks, relation_quota)
+    dead_ends = np.flatnonzero(~alive)
+    start_nodes = np.concatenate([np.repeat(np.arange(num_nodes), c) for c in per_relation.values()] +
+                                 [np.repeat(dead_ends, dead_end_walks)]).astype(np.int64)
+    first_relations = np.concatenate([np.full(c.sum(), r, dtype=np.int32) for r, c in per_relation.items()] +
+                                     [np.full(len(dead_ends) * dead_end_walks, -1, dtype=np.int32)])
+    order = rng.permutation(len(start_nodes))
+    start_nodes, first_relations = start_nodes[order], first_relations[order]
+    counts = np.bincount(start_nodes, minlength=num_nodes)
+    walked_alive = counts[alive].sum()
+    for relation, name in enumerate(G.relation_names):
+      share = per_relation[relation].sum() if relation in per_relation else 0
+      first_hops[name] = float(share / walked_alive) if walked_alive else 0.0
+  else:
+    counts = walks_per_node(G, num_walks, strategy, dead_end_walks, relation_quota)
+    start_nodes = np.repeat(np.arange(num_nodes), counts)
+    rng.shuffle(start_nodes)
+    first_relations = None
+    walked_alive = counts[alive].sum()
+    for relation, name in enumerate(G.relation_names):
+      share = (counts[alive] * relation_edge_counts(G, relation)[alive] / degrees[alive]).sum()
+      first_hops[name] = float(share / walked_alive) if walked_alive else 0.0
+
+  report = {
+    "strategy": strategy,
+    "walks": int(counts.sum()),
+    "start_nodes": int((counts > 0).sum()),
+    "dead_ends": int((~alive).sum()),
+    "dead_ends_skipped": int(((~alive) & (counts == 0)).sum()),
+    "walks_from_dead_ends": int(counts[~alive].sum()),
+    "expected_first_hop_relations": first_hops,
+  }
+  return start_nodes, first_relations, report
@@ -0,0 +1,158 @@
+import codecs
+import json
+import os
+import pickle
+import numpy as np
+
+# Compact on-disk format for random walks.
+#
+# A walk store is a directory holding
+#   tokens.bin     int32 token ids of all walks back to back, where even positions
+#                  of a walk are node ids and odd positions relation ids
+#   offsets.bin    int64 offsets, walk i is tokens[offsets[i]:offsets[i + 1]]
+#   nodes.txt      node names, one per line, in id order
+#   relations.txt  relation names, one per line, in id order
+#   meta.json      format version, counts and the parameters of the run
+# Both .bin files are raw little-endian arrays that np.memmap opens directly.
+
+FORMAT_VERSION = 1
+
+
+def write_names(path, names):
+  with codecs.open(path, "w", "utf8") as out:
+    for name in names:
+      out.write(name + "\n")
+
+
+def read_names(path):
+  with codecs.open(path, "r", "utf8") as f:
+    return f.read().split("\n")[:-1]
+
+
+class WalkStoreWriter():
+  '''
+  Appends batches of encoded walks to a new walk store. Use as a context manager,
+  the store is complete once the writer is closed.
+  '''
+  def __init__(self, path, node_names, relation_names, meta=None):
+    os.makedirs(path, exist_ok=True)
+    self.path = path
+    self.node_names = node_names
+    self.relation_names = relation_names
+    self.meta = dict(meta or {})
+    self.num_walks = 0
+    self.num_tokens = 0
+    self.tokens = open(os.path.join(path, "tokens.bin"), "wb")
+    self.offsets = open(os.path.join(path, "offsets.bin"), "wb")
+    self.offsets.write(np.zeros(1, dtype="<i8").tobytes())
+
+  def append(self, tokens, bounds):
+    '''
+    Appends walks given as a flat token array plus the offsets where each walk
+    begins, as returned by Graph.walk_batch.
+    '''
+    bounds = np.asarray(bounds, dtype=np.int64)
+    self.tokens.write(np.asarray(tokens, dtype="<i4").tobytes())
+    self.offsets.write((bounds[1:] - bounds[0] + self.num_tokens).astype("<i8").tobytes())
+    self.num_walks += len(bounds) - 1
+    self.num_tokens += int(bounds[-1] - bounds[0])
+
+  def append_walks(self, walks, node_ids, relation_ids):
+    '''
+    Appends walks given as lists of names, encoded through the node_ids and
+    relation_ids dicts.
+    '''
+    bounds = np.zeros(len(walks) + 1, dtype=np.int64)
+    np.cumsum([len(walk) for walk in walks], out=bounds[1:])
+    tokens = np.fromiter(
+      (relation_ids[token] if i % 2 else node_ids[token] for walk in walks for i, token in enumerate(walk)),
+      dtype=np.int32, count=bounds[-1])
+    self.append(tokens, bounds)
+
+  def close(self):
+    self.tokens.close()
+    self.offsets.close()
+    write_names(os.path.join(self.path, "nodes.txt"), self.node_names)
+    write_names(os.path.join(self.path, "relations.txt"), self.relation_names)
+    meta = dict(self.meta, format_version=FORMAT_VERSION, num_walks=self.num_walks, num_tokens=self.num_tokens)
+    with open(os.path.join(self.path, "meta.json"), "w") as out:
+      json.dump(meta, out, indent=2)
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc):
+    self.close()
+
+
+class WalkStore():
+  '''
+  Read-only view of a walk store. The token and offset arrays are memory-mapped,
+  so opening a store costs no deserialization. Indexing returns walks as lists of
+  names, the same structure as the old pickled list of lists.
+  '''
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json")) as f:
+      self.meta = json.load(f)
+    if self.meta["format_version"] != FORMAT_VERSION:
+      raise ValueError("Unsupported walk store version %s in %s" % (self.meta["format_version"], path))
+    self.path = path
+    self.tokens = np.memmap(os.path.join(path, "tokens.bin"), dtype="<i4", mode="r", shape=(self.meta["num_tokens"],)) \
+      if self.meta["num_tokens"] else np.zeros(0, dtype=np.int32)
+    self.offsets = np.memmap(os.path.join(path, "offsets.bin"), dtype="<i8", mode="r", shape=(self.meta["num_walks"] + 1,))
+    self.node_names = read_names(os.path.join(path, "nodes.txt"))
+    self.relation_names = read_names(os.path.join(path, "relations.txt"))
+
+  def __len__(self):
+    return self.meta["num_walks"]
+
+  def walk_ids(self, i):
+    return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+  def decode(self, ids):
+    return [self.relation_names[token] if i % 2 else self.node_names[token] for i, token in enumerate(ids)]
+
+  def __getitem__(self, i):
+    if isinstance(i, slice):
+      return [self.decode(self.walk_ids(j).tolist()) for j in range(*i.indices(len(self)))]
+    if i < 0:
+      i += len(self)
+    return self.decode(self.walk_ids(i).tolist())
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield self[i]
+
+
+def is_walk_store(path):
+  return os.path.isfile(os.path.join(path, "meta.json"))
+
+
+def load_walks(path):
+  '''
+  Opens a walk store, or unpickles a list of walks if path is a pickle file.
+  '''
+  if is_walk_store(path):
+    return WalkStore(path)
+  with open(path, "rb") as f:
+    return pickle.load(f)
+
+
+def convert_pickled_walks(pickle_path, output_path):
+  '''
+  Converts a pickled list of walks, as written by older versions of
+  random_walks.py, to a walk store. Nodes and relations are numbered in the
+  order they first appear.
+  '''
+  with open(pickle_path, "rb") as f:
+    walks = pickle.load(f)
+  node_ids = {}
+  relation_ids = {}
+  for walk in walks:
+    for i, token in enumerate(walk):
+      ids = relation_ids if i % 2 else node_ids
+      if token not in ids:
+        ids[token] = len(ids)
+  with WalkStoreWriter(output_path, list(node_ids), list(relation_ids), meta={"converted_from": pickle_path}) as writer:
+    writer.append_walks(walks, node_ids, relation_ids)
+  return WalkStore(output_path)
@@ -19,13 +19,22 @@ This script is a modifyed version of the original Huggingface mlm.py script, wit
 # Y
 
 import argparse
+import contextlib
+import hashlib
+import inspect
+import itertools
+import json
 import logging
-import copy
 import math
 from torch import nn
 import os
 import random
+import shutil
+import sys
+import threading
+import time
 import datasets
+import numpy as np
 import torch
 from datasets import load_dataset
 from torch.utils.data.dataloader import DataLoader
@@ -47,6 +56,9 @@ from transformers import (
 )
 from transformers.adapters.composition import Fuse
 from torch.utils.tensorboard import SummaryWriter
+from randomwalks_utility.stage_cache import StageCache
+from randomwalks_utility.token_store import FORMAT_VERSION as TOKEN_STORE_VERSION
+from randomwalks_utility.token_store import TokenStore, TokenStoreWriter, is_token_store
 
 
 logger = logging.getLogger(__name__)
@@ -54,9 +66,25 @@ MODEL_CONFIG_CLASSES = list(MODEL_MAPPING.keys())
 MODEL_TYPES = tuple(conf.model_type for conf in MODEL_CONFIG_CLASSES)
 
 
-def parse_args():
+def str2bool(value):
+    """
+    Parses boolean flags like `--line_by_line True`. Plain `type=bool` turns every non-empty string, "False"
+    included, into True.
+    """
+    if isinstance(value, bool):
+        return value
+    if value.lower() in ("yes", "true", "t", "y", "1"):
+        return True
+    if value.lower() in ("no", "false", "f", "n", "0"):
+        return False
+    raise argparse.ArgumentTypeError(f"Boolean value expected, got {value}.")
+
+
+def parse_args(argv=None, preprocess=False):
     parser = argparse.ArgumentParser(
-        description="Finetunes an adapter model using the Masked Language Modeling task")
+        description="Tokenizes the training and validation files once into token stores"
+        if preprocess
+        else "Finetunes an adapter model using the Masked Language Modeling task")
     parser.add_argument(
         "--dataset_name",
         type=str,
@@ -75,6 +103,26 @@ def parse_args():
     parser.add_argument(
         "--validation_file", type=str, default=None, help="A csv or a json file containing the validation data."
     )
+    parser.add_argument(
+        "--train_token_store",
+        type=str,
+        default=None,
+        help="A token store of pretokenized training lines, as written by create_corpora_from_random_walks.py. "
+        "Used instead of --train_file, without any tokenization pass.",
+    )
+    parser.add_argument(
+        "--validation_token_store",
+        type=str,
+        default=None,
+        help="A token store of pretokenized validation lines, used instead of --validation_file.",
+    )
+    parser.add_argument(
+        "--token_store_dir",
+        type=str,
+        default=None,
+        help="Where `run_mlm.py preprocess` writes the tokenized training and validation files. Training runs "
+        "given the same directory read the store matching their files, tokenizer, max_seq_length and line_by_line.",
+    )
     parser.add_argument(
         "--validation_split_percentage",
         default=5,
@@ -128,6 +176,21 @@ def parse_args():
     )
     parser.add_argument("--weight_decay", type=float,
                         default=0.01, help="Weight decay to use.")
+    parser.add_argument(
+        "--mixed_precision",
+        type=str,
+        default="no",
+        choices=["no", "fp16", "bf16"],
+        help="Train in fp32, fp16 with loss scaling (GPU only) or bf16 autocast, which also runs on CPU.",
+    )
+    parser.add_argument(
+        "--optimizer_impl",
+        type=str,
+        default="transformers",
+        choices=["transformers", "torch", "foreach", "fused"],
+        help="AdamW implementation: transformers.AdamW, or torch.optim.AdamW looping over parameters, with multi-tensor "
+        "(foreach) kernels or fused CUDA kernels. Falls back to the closest implementation the installed torch has.",
+    )
     parser.add_argument("--num_train_epochs", type=int, default=3,
                         help="Total number of training epochs to perform.")
     parser.add_argument(
@@ -157,6 +220,20 @@ def parse_args():
                         help="Where to store the final model.")
     parser.add_argument("--seed", type=int, default=42,
                         help="A seed for reproducible training.")
+    parser.add_argument(
+        "--checkpointing_steps",
+        type=int,
+        default=None,
+        help="Save a checkpoint of the trainable parameters and the training state to output_dir/step_<n> every n "
+        "optimizer steps.",
+    )
+    parser.add_argument(
+        "--resume_from_checkpoint",
+        type=str,
+        default=None,
+        help="A checkpoint directory written with --checkpointing_steps, or latest for the newest one in output_dir. "
+        "Training continues at the batch after the checkpoint.",
+    )
     parser.add_argument(
         "--model_type",
         type=str,
@@ -172,7 +249,9 @@ def parse_args():
     )
     parser.add_argument(
         "--line_by_line",
-        type=bool,
+        type=str2bool,
+        nargs="?",
+        const=True,
         default=True,
         help="Whether distinct lines of text in the dataset are to be handled as distinct sequences.",
     )
@@ -183,11 +262,50 @@ def parse_args():
         help="The number of processes to use for the preprocessing.",
     )
     parser.add_argument(
-        "--overwrite_cache", type=bool, default=False, help="Overwrite the cached training and evaluation sets"
+        "--overwrite_cache",
+        type=str2bool,
+        nargs="?",
+        const=True,
+        default=False,
+        help="Overwrite the cached training and evaluation sets",
     )
     parser.add_argument(
         "--mlm_probability", type=float, default=0.15, help="Ratio of tokens to mask for masked language modeling loss"
     )
+    parser.add_argument(
+        "--mlm_collator",
+        type=str,
+        default="transformers",
+        choices=["fast", "transformers"],
+        help="fast pads and masks every batch with a few vectorized tensor operations, transformers uses "
+        "DataCollatorForLanguageModeling.",
+    )
+    parser.add_argument(
+        "--dataloader_num_workers",
+        type=int,
+        default=0,
+        help="Number of DataLoader worker processes that collate and mask batches. 0 does it in the main process.",
+    )
+    parser.add_argument(
+        "--group_by_length",
+        action="store_true",
+        help="Batch training examples of similar length together to cut the padding of dynamic padding. Batches are "
+        "still drawn in random order.",
+    )
+    parser.add_argument(
+        "--packing",
+        type=str,
+        default="none",
+        choices=["none", "position_ids", "block_diagonal"],
+        help="Pack several tokenized lines into every max_seq_length row instead of padding each line. Position ids "
+        "restart with every line, and block_diagonal also keeps lines from attending to each other.",
+    )
+    parser.add_argument(
+        "--length_group_size",
+        type=int,
+        default=100,
+        help="With --group_by_length, examples are sorted by length within groups of this many batches.",
+    )
 
     parser.add_argument(
         "--adapter_name",
@@ -247,16 +365,32 @@ def parse_args():
 
     parser.add_argument(
         "--tune_all_parameters",
-        type=bool,
+        type=str2bool,
+        nargs="?",
+        const=True,
         default=False,
         help="Keep the original transformer parameters open. Tune everything, included the adapter, on the mlm objective.",
     )
 
 
-    args = parser.parse_args()
+    args = parser.parse_args(argv)
 
     # Sanity checks
-    if args.dataset_name is None and args.train_file is None and args.validation_file is None:
+    if args.token_store_dir is not None or preprocess:
+        if args.train_file is None or args.validation_file is None or args.dataset_name is not None:
+            raise ValueError("Token stores are built from a training and a validation file.")
+        if preprocess and args.token_store_dir is None:
+            raise ValueError("Need a --token_store_dir to write the token stores to.")
+        if not args.train_file.endswith(".txt") or not args.validation_file.endswith(".txt"):
+            raise ValueError("Token stores are built from txt files.")
+        if args.train_token_store is not None:
+            raise ValueError("Use either --token_store_dir or --train_token_store, not both.")
+    if (args.train_token_store is None) != (args.validation_token_store is None):
+        raise ValueError("Need both --train_token_store and --validation_token_store, or neither.")
+    if args.train_token_store is not None:
+        if args.dataset_name is not None or args.train_file is not None or args.validation_file is not None:
+            raise ValueError("Token stores replace the dataset name and the training/validation files.")
+    elif args.dataset_name is None and args.train_file is None and args.validation_file is None:
         raise ValueError(
             "Need either a dataset name or a training/validation file.")
     else:
@@ -269,33 +403,831 @@ def parse_args():
             assert extension in [
                 "csv", "json", "txt"], "`validation_file` should be a csv, json or txt file."
 
-    if args.output_dir is not None:
+    if args.packing != "none":
+        if args.group_by_length or args.pad_to_max_length:
+            raise ValueError("--packing fills rows itself, it can not be combined with --group_by_length or "
+                             "--pad_to_max_length.")
+        # Packing fills rows with whole lines, so lines are tokenized one by one
+        args.line_by_line = True
+
+    if (args.checkpointing_steps is not None or args.resume_from_checkpoint == "latest") and args.output_dir is None:
+        raise ValueError("Checkpoints are kept in --output_dir, pass one.")
+
+    if args.output_dir is not None and not preprocess:
         os.makedirs(args.output_dir, exist_ok=True)
 
     return args
 
 
-def adapter_drop(old_model: nn.Module, adapters_to_prune=[1,3,5,7,10], logger=None) -> nn.Module:
+def load_tokenizer(args):
+    if args.tokenizer_name:
+        return AutoTokenizer.from_pretrained(args.tokenizer_name, use_fast=not args.use_slow_tokenizer)
+    elif args.model_name_or_path:
+        return AutoTokenizer.from_pretrained(args.model_name_or_path, use_fast=not args.use_slow_tokenizer)
+    raise ValueError(
+        "You are instantiating a new tokenizer from scratch. This is not supported by this script."
+        "You can do it from another script, save it, and load it from here, using --tokenizer_name."
+    )
+
+
+def resolve_max_seq_length(args, tokenizer):
+    if args.max_seq_length is None:
+        max_seq_length = tokenizer.model_max_length
+        if max_seq_length > 1024:
+            logger.warn(
+                f"The tokenizer picked seems to have a very large `model_max_length` ({tokenizer.model_max_length}). "
+                "Picking 1024 instead. You can change that default value by passing --max_seq_length xxx."
+            )
+            max_seq_length = 1024
+    else:
+        if args.max_seq_length > tokenizer.model_max_length:
+            logger.warn(
+                f"The max_seq_length passed ({args.max_seq_length}) is larger than the maximum length for the"
+                f"model ({tokenizer.model_max_length}). Using max_seq_length={tokenizer.model_max_length}."
+            )
+        max_seq_length = min(args.max_seq_length, tokenizer.model_max_length)
+    return max_seq_length
+
+
+def tokenizer_fingerprint(tokenizer):
+    """
+    Hashes what decides how a tokenizer encodes text: its class, vocabulary, special tokens and casing.
+    """
+    digest = hashlib.sha256()
+    digest.update(type(tokenizer).__name__.encode("utf8"))
+    digest.update(json.dumps(sorted(tokenizer.get_vocab().items())).encode("utf8"))
+    digest.update(json.dumps(tokenizer.all_special_tokens).encode("utf8"))
+    digest.update(str(getattr(tokenizer, "do_lower_case", None)).encode("utf8"))
+    return digest.hexdigest()
+
+
+def token_store_path(args, split_file, tokenizer, max_seq_length, digest_cache):
+    """
+    Where the token store of split_file lives under --token_store_dir. The name hashes everything that changes the
+    stored sequences, so a changed file, tokenizer or setting never picks up a stale store. digest_cache is a
+    StageCache over --token_store_dir that remembers the file's digest while its size and mtime stay the same.
+    """
+    key = {
+        "format_version": TOKEN_STORE_VERSION,
+        "file": digest_cache.file_digest(split_file),
+        "tokenizer": tokenizer_fingerprint(tokenizer),
+        "max_seq_length": max_seq_length,
+        "line_by_line": args.line_by_line,
+    }
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode("utf8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(split_file))[0]
+    return os.path.join(args.token_store_dir, f"{name}-{digest}")
+
+
+def iter_line_batches(path, batch_size=10000):
+    with open(path, encoding="utf8") as f:
+        batch = []
+        for line in f:
+            batch.append(line.rstrip("\n"))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+
+def write_token_store(args, split_file, output_path, tokenizer, max_seq_length):
+    """
+    Tokenizes split_file into a token store of finished examples, special tokens included. With line_by_line every
+    non-empty line is one example truncated to max_seq_length, otherwise the tokenized lines are concatenated and cut
+    into examples of max_seq_length, dropping only the remainder at the end of the file.
+    """
+    scratch = f"{output_path}.tmp{os.getpid()}"
+    meta = {
+        "source": split_file,
+        "tokenizer": tokenizer.name_or_path,
+        "max_seq_length": max_seq_length,
+        "line_by_line": args.line_by_line,
+        "special_tokens": True,
+    }
+    remainder = []
+    with TokenStoreWriter(scratch, len(tokenizer), meta) as writer:
+        for lines in tqdm(iter_line_batches(split_file), desc=f"Tokenizing {split_file}"):
+            if args.line_by_line:
+                lines = [line for line in lines if len(line) > 0 and not line.isspace()]
+                sequences = tokenizer(lines, truncation=True, max_length=max_seq_length)["input_ids"]
+            else:
+                for input_ids in tokenizer(lines)["input_ids"]:
+                    remainder.extend(input_ids)
+                cut = len(remainder) // max_seq_length * max_seq_length
+                sequences = [remainder[i : i + max_seq_length] for i in range(0, cut, max_seq_length)]
+                remainder = remainder[cut:]
+            writer.append_sequences(sequences)
+    if os.path.isdir(output_path):
+        shutil.rmtree(output_path)
+    os.rename(scratch, output_path)
+    logger.info(f"Wrote {writer.num_sequences} examples, {writer.num_tokens} tokens, to {output_path}")
+
+
+def preprocess(args):
+    """
+    `run_mlm.py preprocess ...` tokenizes --train_file and --validation_file into token stores under
+    --token_store_dir, which later training runs with the same files, tokenizer, max_seq_length and line_by_line open
+    instead of tokenizing again. Existing stores are kept unless --overwrite_cache is set.
+    """
+    logging.basicConfig(
+        format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
+        datefmt="%m/%d/%Y %H:%M:%S",
+        level=logging.INFO,
+    )
+    logger.setLevel(logging.INFO)
+    tokenizer = load_tokenizer(args)
+    max_seq_length = resolve_max_seq_length(args, tokenizer)
+    digest_cache = StageCache(args.token_store_dir)
+    for split_file in (args.train_file, args.validation_file):
+        output_path = token_store_path(args, split_file, tokenizer, max_seq_length, digest_cache)
+        if is_token_store(output_path) and not args.overwrite_cache:
+            logger.info(f"Token store {output_path} for {split_file} exists already")
+            continue
+        write_token_store(args, split_file, output_path, tokenizer, max_seq_length)
+    digest_cache.flush()
+
+
+class TokenStoreDataset(torch.utils.data.Dataset):
+    """
+    Serves a token store as MLM examples. Stores of raw lines, as written by create_corpora_from_random_walks.py, get
+    special tokens added and are truncated to max_seq_length on access, giving the same examples tokenize_function
+    does for the corresponding text file. Stores written by `run_mlm.py preprocess` hold finished examples.
+    """
+
+    def __init__(self, path, tokenizer, max_seq_length, pad_to_max_length=False, return_special_tokens_mask=True):
+        self.store = TokenStore(path)
+        self.finished = self.store.meta.get("special_tokens", False)
+        if self.store.meta["vocab_size"] != len(tokenizer):
+            raise ValueError(
+                f"{path} was tokenized with {self.store.meta['tokenizer']}, whose vocabulary size "
+                f"{self.store.meta['vocab_size']} differs from the tokenizer's {len(tokenizer)}."
+            )
+        self.tokenizer = tokenizer
+        self.max_seq_length = max_seq_length
+        self.max_line_length = max_seq_length - tokenizer.num_special_tokens_to_add(pair=False)
+        self.pad_to_max_length = pad_to_max_length
+        # FastMLMCollator finds special tokens itself, so the per example mask can be skipped
+        self.return_special_tokens_mask = return_special_tokens_mask
+
+    def __len__(self):
+        return len(self.store)
+
+    def lengths(self):
+        if self.finished:
+            return self.store.lengths()
+        special = self.max_seq_length - self.max_line_length
+        return np.minimum(self.store.lengths(), self.max_line_length) + special
+
+    def __getitem__(self, i):
+        if self.finished:
+            input_ids = self.store[i].tolist()
+        else:
+            input_ids = self.tokenizer.build_inputs_with_special_tokens(self.store[i][: self.max_line_length].tolist())
+        attention_mask = [1] * len(input_ids)
+        padding = self.max_seq_length - len(input_ids) if self.pad_to_max_length else 0
+        example = {
+            "input_ids": input_ids + [self.tokenizer.pad_token_id] * padding,
+            "attention_mask": attention_mask + [0] * padding,
+        }
+        if self.return_special_tokens_mask:
+            special_tokens_mask = self.tokenizer.get_special_tokens_mask(input_ids, already_has_special_tokens=True)
+            example["special_tokens_mask"] = special_tokens_mask + [1] * padding
+        return example
+
+
+def dataset_lengths(dataset):
+    """
+    Token counts of every example of a tokenized dataset or TokenStoreDataset.
+    """
+    if isinstance(dataset, TokenStoreDataset):
+        return dataset.lengths()
+    return np.array([len(input_ids) for input_ids in dataset["input_ids"]], dtype=np.int64)
+
+
+def padding_overhead(lengths, batches):
+    """
+    Fraction of the tokens of padded batches that are padding.
+    """
+    padded = sum(int(lengths[batch].max()) * len(batch) for batch in batches)
+    return 1.0 - float(lengths.sum()) / padded if padded else 0.0
+
+
+class LengthGroupedBatchSampler(torch.utils.data.Sampler):
+    """
+    Yields batches of example indices with similar lengths. Every epoch shuffles the examples, sorts them by length
+    within groups of group_size batches and cuts the groups into batches, whose order is then shuffled again, so
+    batches of every length come up throughout the epoch. The one batch short of batch_size always comes last, as
+    accelerate's batch sharding only completes a round of processes with full batches. The order only depends on seed
+    and the epoch set with set_epoch, so all processes draw the same batches and accelerate can shard them.
+    """
+
+    def __init__(self, lengths, batch_size, group_size=100, seed=0):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.group_size = group_size
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def batches(self):
+        rng = np.random.default_rng([self.seed, self.epoch])
+        order = rng.permutation(len(self.lengths))
+        group = self.batch_size * self.group_size
+        batches = []
+        for start in range(0, len(order), group):
+            members = order[start : start + group]
+            members = members[np.argsort(-self.lengths[members], kind="stable")]
+            batches.extend(members[i : i + self.batch_size] for i in range(0, len(members), self.batch_size))
+        # Only the very last batch can be short, it stays at the end
+        full = len(batches) - (len(batches) > 0 and len(batches[-1]) < self.batch_size)
+        return [batches[i] for i in rng.permutation(full)] + batches[full:]
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+
+    def __len__(self):
+        return math.ceil(len(self.lengths) / self.batch_size)
+
+    def padding_report(self):
+        """
+        Padding overhead of this epoch's batches next to that of random batches of the same size.
+        """
+        rng = np.random.default_rng([self.seed, self.epoch, 1])
+        order = rng.permutation(len(self.lengths))
+        random_batches = [order[i : i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        return padding_overhead(self.lengths, self.batches()), padding_overhead(self.lengths, random_batches)
+
+
+def pack_examples(lengths, max_seq_length, seed=0):
+    """
+    Packs examples into rows of at most max_seq_length tokens, filling rows in a shuffled order and starting a new row
+    whenever the next example does not fit. Every example ends up in exactly one row. Returns the example indices of
+    every row.
+    """
+    order = np.random.default_rng(seed).permutation(len(lengths))
+    rows, row, used = [], [], 0
+    for index, length in zip(order.tolist(), np.asarray(lengths)[order].tolist()):
+        if row and used + length > max_seq_length:
+            rows.append(row)
+            row, used = [], 0
+        row.append(index)
+        used += length
+    if row:
+        rows.append(row)
+    return rows
+
+
+class FastMLMCollator:
+    """
+    Pads and masks batches for masked language modeling, like DataCollatorForLanguageModeling, with a few vectorized
+    tensor operations per batch. Special tokens are found with a lookup table over the vocabulary built once, instead
+    of a mask per example. Like the special_tokens_mask of fast tokenizers, the table only holds the tokens framing a
+    sequence plus padding and [MASK], so [UNK] is masked and predicted like any other token. Masking takes one uniform
+    draw per token: below 0.8 * mlm_probability the token becomes [MASK], up to 0.9 * mlm_probability a random token
+    read off the same draw, up to mlm_probability it is kept, and all of these are predicted. The collator is
+    picklable, so it runs in DataLoader worker processes.
+    """
+
+    def __init__(self, tokenizer, mlm_probability=0.15):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.mask_token_id = tokenizer.mask_token_id
+        self.vocab_size = len(tokenizer)
+        self.mlm_probability = mlm_probability
+        self.is_special = torch.zeros(self.vocab_size, dtype=torch.bool)
+        framing = [tokenizer.cls_token_id, tokenizer.sep_token_id, tokenizer.bos_token_id, tokenizer.eos_token_id]
+        self.is_special[[i for i in framing + [self.pad_token_id, self.mask_token_id] if i is not None]] = True
+
+    def mask_tokens(self, inputs, special_tokens_mask=None):
+        """
+        Masks inputs in place and returns them with the labels, -100 where no prediction is made.
+        """
+        p = self.mlm_probability
+        if special_tokens_mask is None:
+            special_tokens_mask = self.is_special[inputs]
+        # float64, so rescaling the draw to a token id stays uniform even for large vocabularies
+        draw = torch.rand(inputs.shape, dtype=torch.float64)
+        draw.masked_fill_(special_tokens_mask.bool(), 1.0)
+        labels = torch.where(draw < p, inputs, torch.full_like(inputs, -100))
+        # Within [0.8 * p, 0.9 * p) the draw is uniform, rescaled it picks the random token
+        replace = (draw >= 0.8 * p) & (draw < 0.9 * p)
+        random_ids = ((draw - 0.8 * p) / (0.1 * p) * self.vocab_size).long().clamp_(0, self.vocab_size - 1)
+        inputs[replace] = random_ids[replace]
+        inputs[draw < 0.8 * p] = self.mask_token_id
+        return inputs, labels
+
+    def __call__(self, examples):
+        lengths = torch.tensor([len(example["input_ids"]) for example in examples])
+        input_ids = torch.full((len(examples), int(lengths.max())), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros(input_ids.shape, dtype=torch.long)
+        # Scatter all examples into the padded batch at once. The batch tensors are not reused across calls, batches
+        # may still sit in the DataLoader's queues or shared memory when the next one is collated.
+        rows = torch.repeat_interleave(torch.arange(len(examples)), lengths)
+        cols = torch.arange(int(lengths.sum())) - torch.repeat_interleave(torch.cumsum(lengths, 0) - lengths, lengths)
+        input_ids[rows, cols] = torch.tensor(list(itertools.chain.from_iterable(e["input_ids"] for e in examples)))
+        if "attention_mask" in examples[0]:
+            attention_mask[rows, cols] = torch.tensor(
+                list(itertools.chain.from_iterable(e["attention_mask"] for e in examples))
+            )
+        else:
+            attention_mask[rows, cols] = 1
+        input_ids, labels = self.mask_tokens(input_ids)
+        return {"input_ids": input_ids, "attention_mask": attention_mask, "labels": labels}
+
+
+class PackedDataset(torch.utils.data.Dataset):
+    """
+    Serves rows of several complete line by line examples, see pack_examples. Each row carries the position ids of its
+    tokens, which restart at position_offset for every example, and the index of the example each token belongs to.
+    """
+
+    def __init__(self, dataset, max_seq_length, seed=0, position_offset=0):
+        self.dataset = dataset
+        lengths = dataset_lengths(dataset)
+        self.rows = pack_examples(lengths, max_seq_length, seed)
+        self.position_offset = position_offset
+        self.fill = float(lengths.sum()) / (len(self.rows) * max_seq_length) if self.rows else 0.0
+
+    def __len__(self):
+        return len(self.rows)
+
+    def __getitem__(self, r):
+        input_ids, special_tokens_mask, position_ids, sequence_ids = [], [], [], []
+        for k, i in enumerate(self.rows[r]):
+            example = self.dataset[i]
+            length = len(example["input_ids"])
+            input_ids.extend(example["input_ids"])
+            special_tokens_mask.extend(example.get("special_tokens_mask", ()))
+            position_ids.extend(range(self.position_offset, self.position_offset + length))
+            sequence_ids.extend([k] * length)
+        row = {"input_ids": input_ids, "position_ids": position_ids, "sequence_ids": sequence_ids}
+        if special_tokens_mask:
+            row["special_tokens_mask"] = special_tokens_mask
+        return row
+
+
+class PackedCollator:
+    """
+    Pads the rows of a PackedDataset and masks them with mlm_collator, a FastMLMCollator or
+    DataCollatorForLanguageModeling. With block_diagonal the attention mask is 3D, so every token only attends to
+    tokens of its own example, otherwise it is the usual 2D padding mask.
+    """
+
+    def __init__(self, tokenizer, mlm_collator, block_diagonal):
+        self.pad_token_id = tokenizer.pad_token_id
+        self.mlm_collator = mlm_collator
+        self.block_diagonal = block_diagonal
+
+    def __call__(self, rows):
+        shape = (len(rows), max(len(row["input_ids"]) for row in rows))
+        input_ids = torch.full(shape, self.pad_token_id, dtype=torch.long)
+        special_tokens_mask = torch.ones(shape, dtype=torch.long) if "special_tokens_mask" in rows[0] else None
+        position_ids = torch.zeros(shape, dtype=torch.long)
+        sequence_ids = torch.full(shape, -1, dtype=torch.long)
+        for k, row in enumerate(rows):
+            length = len(row["input_ids"])
+            input_ids[k, :length] = torch.tensor(row["input_ids"])
+            if special_tokens_mask is not None:
+                special_tokens_mask[k, :length] = torch.tensor(row["special_tokens_mask"])
+            position_ids[k, :length] = torch.tensor(row["position_ids"])
+            sequence_ids[k, :length] = torch.tensor(row["sequence_ids"])
+
+        # Renamed to torch_mask_tokens in later transformers versions
+        mask_tokens = getattr(self.mlm_collator, "torch_mask_tokens", None) or self.mlm_collator.mask_tokens
+        input_ids, labels = mask_tokens(input_ids, special_tokens_mask=special_tokens_mask)
+        if self.block_diagonal:
+            # Padding only attends to padding, which keeps its softmax finite
+            attention_mask = (sequence_ids[:, :, None] == sequence_ids[:, None, :]).long()
+        else:
+            attention_mask = (sequence_ids >= 0).long()
+        return {"input_ids": input_ids, "labels": labels, "attention_mask": attention_mask, "position_ids": position_ids}
+
+
+class SeededCollator:
+    """
+    Runs collate_fn on an RNG stream of its own when it collates in the main process, instead of the global torch RNG
+    the MLM collators mask with. The masking of a batch then only depends on the seed and the batches collated
+    before it in the epoch, not on what training drew in between or on whether the DataLoader fetches a batch ahead,
+    so a resumed run masks its first batch like the interrupted run did. DataLoader worker processes, whose RNG is
+    seeded from the DataLoader's generator, run collate_fn as is.
+    """
+
+    def __init__(self, collate_fn):
+        self.collate_fn = collate_fn
+        self.state = None
+
+    def manual_seed(self, seed):
+        self.state = torch.Generator().manual_seed(seed).get_state()
+
+    def __call__(self, examples):
+        if self.state is None or torch.utils.data.get_worker_info() is not None:
+            return self.collate_fn(examples)
+        with torch.random.fork_rng(devices=[]):
+            torch.set_rng_state(self.state)
+            batch = self.collate_fn(examples)
+            self.state = torch.get_rng_state()
+        return batch
+
+
+def make_accelerator(mixed_precision):
+    """
+    Creates the Accelerator for --mixed_precision. Older accelerate versions only take fp16=True and leave bf16 to
+    autocast_context. fp16 without a GPU fails here with the same error on every accelerate version, newer ones refuse
+    it with their own message and older ones silently train in fp32.
+    """
+    fp16_error = "--mixed_precision fp16 needs a CUDA GPU, use bf16 or no on CPU"
+    if mixed_precision == "bf16" and not hasattr(torch, "autocast"):
+        raise ValueError("--mixed_precision bf16 needs torch 1.10 or newer")
+    if mixed_precision == "fp16" and not torch.cuda.is_available():
+        raise ValueError(fp16_error)
+    if "mixed_precision" in inspect.signature(Accelerator.__init__).parameters:
+        accelerator = Accelerator(mixed_precision=mixed_precision)
+    else:
+        accelerator = Accelerator(fp16=mixed_precision == "fp16")
+    if mixed_precision == "fp16" and accelerator.device.type != "cuda":
+        raise ValueError(fp16_error)
+    return accelerator
+
+
+def autocast_context(accelerator, mixed_precision):
+    """
+    Returns the context to run forward passes in. For bf16 it autocasts on the accelerator's device, CPU included,
+    since not every accelerate version autocasts bf16 on CPU. fp16 autocast and loss scaling are done by accelerate.
+    """
+    if mixed_precision != "bf16":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=accelerator.device.type, dtype=torch.bfloat16)
+
+
+def accumulation_context(accelerator, model, sync_gradients):
+    """
+    Skips the gradient all-reduce of distributed training for micro-batches that do not complete an accumulation
+    window, so gradients are only synchronized once per optimizer step. Older accelerate versions have no no_sync,
+    there the wrapped DistributedDataParallel model provides it.
+    """
+    if sync_gradients:
+        return contextlib.nullcontext()
+    if hasattr(accelerator, "no_sync"):
+        return accelerator.no_sync(model)
+    if hasattr(model, "no_sync"):
+        return model.no_sync()
+    return contextlib.nullcontext()
+
+
+def accumulation_windows(num_batches, gradient_accumulation_steps):
+    """
+    Returns, for every batch of an epoch, whether it completes an accumulation window, after which the optimizer
+    steps, and the number of batches in its window, which its loss is divided by. The last window of an epoch may be
+    short, its gradients are averaged over the batches it has, so every update is the mean gradient of its window.
+    """
+    last_window = num_batches % gradient_accumulation_steps or gradient_accumulation_steps
+    last_window_start = num_batches - last_window
+    return [
+        (
+            (step + 1) % gradient_accumulation_steps == 0 or step == num_batches - 1,
+            last_window if step >= last_window_start else gradient_accumulation_steps,
+        )
+        for step in range(num_batches)
+    ]
+
+
+def accumulate_batch(accelerator, model, batch, window, sync_gradients, mixed_precision="no"):
+    """
+    Runs forward and backward for one micro-batch of an accumulation window of window batches. Gradients are only
+    all-reduced if sync_gradients is set. Returns the detached loss.
+    """
+    with accumulation_context(accelerator, model, sync_gradients):
+        with autocast_context(accelerator, mixed_precision):
+            outputs = model(**batch)
+        loss = outputs.loss
+        accelerator.backward(loss / window)
+    return loss.detach()
+
+
+def torch_adamw(impl):
+    """
+    Returns torch's AdamW class and extra constructor arguments for impl, falling back from fused to foreach to the
+    per parameter loop when the installed torch lacks them. Old torch versions only have multi-tensor AdamW as
+    torch.optim._multi_tensor.AdamW.
+    """
+    supported = inspect.signature(torch.optim.AdamW.__init__).parameters
+    if impl == "fused":
+        if "fused" in supported and torch.cuda.is_available():
+            return torch.optim.AdamW, {"fused": True}
+        logger.warning("Fused AdamW needs a newer torch and a GPU, using foreach AdamW instead")
+        impl = "foreach"
+    if impl == "foreach":
+        if "foreach" in supported:
+            return torch.optim.AdamW, {"foreach": True}
+        multi_tensor = getattr(getattr(torch.optim, "_multi_tensor", None), "AdamW", None)
+        if multi_tensor is not None:
+            return multi_tensor, {}
+        logger.warning("This torch has no foreach AdamW, using the per parameter loop instead")
+    return torch.optim.AdamW, {}
+
+
+def build_optimizer(model, args):
+    """
+    Builds AdamW over the parameters that require gradients only, so the frozen transformer weights left by
+    train_adapter cost no optimizer time or state. Logs how many parameters are trained.
+    """
+    no_decay = ["bias", "LayerNorm.weight"]
+    trainable = [(n, p) for n, p in model.named_parameters() if p.requires_grad]
+    num_trainable = sum(p.numel() for _, p in trainable)
+    num_total = sum(p.numel() for p in model.parameters())
+    logger.info(
+        f"Trainable parameters: {num_trainable:,} of {num_total:,} ({num_trainable / num_total:.2%}) in "
+        f"{len(trainable)} tensors"
+    )
+    # Split weights in two groups, one with weight decay and the other not.
+    optimizer_grouped_parameters = [
+        {
+            "params": [p for n, p in trainable if not any(nd in n for nd in no_decay)],
+            "weight_decay": args.weight_decay,
+        },
+        {
+            "params": [p for n, p in trainable if any(nd in n for nd in no_decay)],
+            "weight_decay": 0.0,
+        },
+    ]
+    optimizer_grouped_parameters = [group for group in optimizer_grouped_parameters if group["params"]]
+    if args.optimizer_impl == "transformers":
+        return AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    optimizer_class, kwargs = torch_adamw(args.optimizer_impl)
+    # transformers.AdamW defaults to eps=1e-6, keep it so only the implementation changes
+    return optimizer_class(optimizer_grouped_parameters, lr=args.learning_rate, eps=1e-6, **kwargs)
+
+
+def epoch_generator_seed(seed, epoch):
+    """
+    Seed of the training data generator in epoch. It only depends on seed and epoch, like the order of
+    LengthGroupedBatchSampler.
+    """
+    return int(np.random.SeedSequence([seed or 0, epoch]).generate_state(1)[0])
+
+
+def epoch_collate_seed(seed, epoch):
+    """
+    Seed of the SeededCollator masking the training batches in epoch, independent of epoch_generator_seed.
+    """
+    return int(np.random.SeedSequence([seed or 0, epoch]).spawn(1)[0].generate_state(1)[0])
+
+
+def to_cpu(obj):
+    """
+    Copies all tensors in nested dicts, lists and tuples to the CPU, so they can be written while training goes on.
+    """
+    if torch.is_tensor(obj):
+        return obj.detach().to("cpu", copy=True)
+    if isinstance(obj, dict):
+        return {k: to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu(v) for v in obj)
+    return obj
+
+
+def load_file(path):
+    # Checkpoints hold RNG states, which newer torch only loads with weights_only=False
+    if "weights_only" in inspect.signature(torch.load).parameters:
+        return torch.load(path, map_location="cpu", weights_only=False)
+    return torch.load(path, map_location="cpu")
+
+
+def rng_state():
+    state = {"python": random.getstate(), "numpy": np.random.get_state(), "torch": torch.get_rng_state()}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state["python"])
+    np.random.set_state(state["numpy"])
+    torch.set_rng_state(state["torch"])
+    if "cuda" in state and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+
+
+CHECKPOINT_COMPLETE = "checkpoint_complete"
+
+
+class CheckpointWriter:
+    """
+    Writes checkpoints on a background thread, one at a time, so the training step does not wait for the disk.
+    trainer_state.json is written last, pending is the path of the last checkpoint saved and not yet marked complete,
+    see complete_checkpoint. Errors of a write are raised by the next save or wait.
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.error = None
+        self.pending = None
+
+    def _write(self, path, files, trainer_state):
+        try:
+            for name, obj in files.items():
+                torch.save(obj, os.path.join(path, name))
+            with open(os.path.join(path, "trainer_state.json"), "w") as f:
+                json.dump(trainer_state, f, indent=2)
+        except Exception as e:
+            self.error = e
+
+    def save(self, path, files, trainer_state):
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(path, files, trainer_state), daemon=True)
+        self.thread.start()
+        self.pending = path
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+
+def complete_checkpoint(checkpoint_writer, accelerator):
+    """
+    Marks the last checkpoint saved as complete, by writing CHECKPOINT_COMPLETE into it once the main process's
+    background write finished and every process saved its RNG states. All processes have to call it at the same
+    point, it waits for all of them.
+    """
+    if accelerator.is_main_process:
+        checkpoint_writer.wait()
+    accelerator.wait_for_everyone()
+    if accelerator.is_main_process and checkpoint_writer.pending is not None:
+        with open(os.path.join(checkpoint_writer.pending, CHECKPOINT_COMPLETE), "w") as f:
+            f.write("")
+        checkpoint_writer.pending = None
+
+
+def save_checkpoint(
+    checkpoint_writer, path, accelerator, model, optimizer, lr_scheduler, position, epoch_generator_state
+):
+    """
+    Saves the parameters that require gradients, the optimizer, scheduler and fp16 loss scaler state, the RNG states
+    and the position, i.e. the epoch, batch and optimizer step reached, to path. The frozen transformer weights are not
+    saved. The state is copied to the CPU here and written by checkpoint_writer in the background. Every process
+    saves its own RNG states, plus the state of the training data generator at the start of the epoch, which the
+    epoch's data order and DataLoader worker seeds were drawn from. The previous checkpoint is marked complete first,
+    so a checkpoint is marked complete at the next save or once training ends.
+    """
+    complete_checkpoint(checkpoint_writer, accelerator)
+    os.makedirs(path, exist_ok=True)
+    rng_file = f"rng_state_{accelerator.process_index}.pt"
+    rng = dict(rng_state(), epoch_generator=epoch_generator_state)
+    if not accelerator.is_main_process:
+        torch.save(rng, os.path.join(path, rng_file))
+        return
+    unwrapped_model = accelerator.unwrap_model(model)
+    files = {
+        "trainable_parameters.pt": {n: p for n, p in unwrapped_model.named_parameters() if p.requires_grad},
+        "optimizer.pt": optimizer.state_dict(),
+        "scheduler.pt": lr_scheduler.state_dict(),
+        rng_file: rng,
+    }
+    if getattr(accelerator, "scaler", None) is not None:
+        files["scaler.pt"] = accelerator.scaler.state_dict()
+    checkpoint_writer.save(path, to_cpu(files), dict(position, num_processes=accelerator.num_processes))
+
+
+def latest_checkpoint(output_dir):
+    complete = [
+        name for name in os.listdir(output_dir)
+        if name.startswith("step_") and os.path.isfile(os.path.join(output_dir, name, CHECKPOINT_COMPLETE))
+    ]
+    if not complete:
+        raise ValueError(f"No complete checkpoint in {output_dir}")
+    return os.path.join(output_dir, max(complete, key=lambda name: int(name[len("step_"):])))
+
+
+def load_checkpoint(path, accelerator, model, optimizer, lr_scheduler):
+    """
+    Restores a checkpoint written by save_checkpoint into the prepared model, optimizer and scheduler. Returns the
+    position and this process's RNG states, which are restored once the dataloader reached the position.
+    """
+    if not os.path.isfile(os.path.join(path, CHECKPOINT_COMPLETE)):
+        raise ValueError(f"{path} is not a complete checkpoint, its writing was interrupted.")
+    with open(os.path.join(path, "trainer_state.json")) as f:
+        position = json.load(f)
+    if position["num_processes"] != accelerator.num_processes:
+        raise ValueError(
+            f"{path} was saved with {position['num_processes']} processes, resuming it needs the same number, not "
+            f"{accelerator.num_processes}."
+        )
+    unwrapped_model = accelerator.unwrap_model(model)
+    saved = load_file(os.path.join(path, "trainable_parameters.pt"))
+    trainable = {n for n, p in unwrapped_model.named_parameters() if p.requires_grad}
+    if set(saved) != trainable:
+        raise ValueError(
+            f"The trainable parameters of {path} do not match the model, for example "
+            f"{sorted(set(saved) ^ trainable)[:5]}. Resume with the same adapter arguments."
+        )
+    unwrapped_model.load_state_dict(saved, strict=False)
+    optimizer.load_state_dict(load_file(os.path.join(path, "optimizer.pt")))
+    lr_scheduler.load_state_dict(load_file(os.path.join(path, "scheduler.pt")))
+    if getattr(accelerator, "scaler", None) is not None and os.path.isfile(os.path.join(path, "scaler.pt")):
+        accelerator.scaler.load_state_dict(load_file(os.path.join(path, "scaler.pt")))
+    rng = load_file(os.path.join(path, f"rng_state_{accelerator.process_index}.pt"))
+    if "epoch_generator" not in rng:
+        raise ValueError(f"{path} predates the training data generator, its data order can not be reproduced.")
+    return position, rng
+
+
+def skip_trained_batches(dataloader, skip_batches, rng):
+    """
+    Yields the (step, batch) pairs of dataloader after its first skip_batches batches, which a resumed run trained on
+    already. The RNG states rng of the checkpoint are restored right after the last skipped batch.
+    """
+    for step, batch in enumerate(dataloader):
+        if step < skip_batches:
+            if step == skip_batches - 1:
+                set_rng_state(rng)
+            continue
+        yield step, batch
+
+
+def forward_flops_per_token(module):
+    """
+    Multiply-adds of the linear layers in module for one token, counted as two FLOPs each. This leaves out attention
+    scores, norms and activations, which adapters hardly add to.
+    """
+    return sum(2 * m.weight.numel() for m in module.modules() if isinstance(m, nn.Linear))
+
+
+def adapter_drop(model: nn.Module, adapter_name, adapters_to_prune=[1,3,5,7,10], optimizer=None, logger=None):
     '''
-    Takes a transformer model with an injected adapter setup and prune the models from specified layers.
+    Removes the adapter adapter_name from the specified layers of the model in place. Call it after train_adapter.
+    The pruned layers are added to the adapter's leave_out, so saving and reloading the adapter keeps them pruned.
+    Pruned parameters are taken out of optimizer if one is given, checkpoints only contain the remaining ones.
         input:
-            old_model(nn.Module): the model to prune layers from
+            model(nn.Module): the model to prune adapters from
+            adapter_name(str): name of the adapter to prune
             adapters_to_prune(List[Int]: The index of the layers to prune adapters from.
+            optimizer(torch.optim.Optimizer): optimizer the pruned parameters are removed from
             logger (logging): logger module, injected
         returns:
-            new_model: the pruned model.
+            report: pruned layers, the parameters removed and the forward FLOPs per token saved.
     '''
-    new_model = copy.deepcopy(old_model)
-    for layer in adapters_to_prune:
-        layer = int(layer)
-        if logger:
-            logger.info(f"Pruning from layer {layer}")
-        new_model.base_model.encoder.layer[layer].output.adapters = nn.ModuleDict()
-        new_model.base_model.encoder.layer[layer].attention.output.adapters = nn.ModuleDict()
-    return new_model
+    layers = sorted({int(layer) for layer in adapters_to_prune})
+    model_flops = forward_flops_per_token(model)
+    removed = []
+    adapter_parameters = 0
+    flops = 0
+    for index, layer in enumerate(model.base_model.encoder.layer):
+        for location in (layer.attention.output, layer.output):
+            if adapter_name not in location.adapters:
+                continue
+            adapter = location.adapters[adapter_name]
+            adapter_parameters += sum(p.numel() for p in adapter.parameters())
+            if index in layers:
+                removed.extend(adapter.parameters())
+                flops += forward_flops_per_token(adapter)
+                del location.adapters[adapter_name]
+        if logger and index in layers:
+            logger.info(f"Pruning from layer {index}")
+
+    # Record the pruned layers in the adapter's config
+    adapters_config = model.config.adapters
+    config = dict(adapters_config.get(adapter_name))
+    config["leave_out"] = sorted(set(config.get("leave_out") or []) | set(layers))
+    del adapters_config.adapters[adapter_name]
+    adapters_config.add(adapter_name, config=AdapterConfig.load(config))
+
+    if optimizer is not None:
+        removed_ids = {id(p) for p in removed}
+        # An accelerate optimizer wraps the torch one
+        inner = getattr(optimizer, "optimizer", optimizer)
+        for group in inner.param_groups:
+            group["params"] = [p for p in group["params"] if id(p) not in removed_ids]
+        for p in removed:
+            inner.state.pop(p, None)
+
+    num_removed = sum(p.numel() for p in removed)
+    report = {
+        "layers": layers,
+        "parameters_removed": num_removed,
+        "adapter_parameters_before": adapter_parameters,
+        "flops_per_token_saved": flops,
+        "model_flops_per_token_before": model_flops,
+    }
+    if logger:
+        logger.info(
+            f"Adapter drop removed {num_removed:,} of {adapter_parameters:,} parameters of {adapter_name} "
+            f"({num_removed / max(adapter_parameters, 1):.1%}) and {flops / 1e6:.2f} of {model_flops / 1e6:.1f} "
+            f"MFLOPs per token in the forward pass ({flops / max(model_flops, 1):.2%})"
+        )
+    return report
 
 
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "preprocess":
+        preprocess(parse_args(sys.argv[2:], preprocess=True))
+        return
     args = parse_args()
 
     #Sanity checks
@@ -308,7 +1240,7 @@ def main():
 
 
     # Initialize the accelerator. We will let the accelerator handle device placement for us in this example.
-    accelerator = Accelerator()
+    accelerator = make_accelerator(args.mixed_precision)
     # Make one log on every process with the configuration for debugging.
     logging.basicConfig(
         format="%(asctime)s - %(levelname)s - %(name)s -   %(message)s",
@@ -316,6 +1248,8 @@ def main():
         level=logging.INFO,
     )
     logger.info(accelerator.state)
+    if args.mixed_precision == "bf16" and accelerator.device.type == "cuda" and not torch.cuda.is_bf16_supported():
+        logger.warning("This GPU does not support bf16, autocast will emulate it slowly")
 
     # Setup logging, we only want one process per machine to log things on the screen.
     # accelerator.is_local_main_process is only True for one process per machine.
@@ -341,7 +1275,10 @@ def main():
     #
     # In distributed training, the load_dataset function guarantee that only one local process can concurrently
     # download the dataset.
-    if args.dataset_name is not None:
+    if args.train_token_store is not None or args.token_store_dir is not None:
+        logger.info("Reading pretokenized token stores, skipping dataset loading and tokenization")
+        raw_datasets = None
+    elif args.dataset_name is not None:
         # Downloading and loading a dataset from the hub.
         raw_datasets = load_dataset(
             args.dataset_name, args.dataset_config_name)
@@ -383,17 +1320,7 @@ def main():
         logger.warning(
             "You are instantiating a new config instance from scratch.")
 
-    if args.tokenizer_name:
-        tokenizer = AutoTokenizer.from_pretrained(
-            args.tokenizer_name, use_fast=not args.use_slow_tokenizer)
-    elif args.model_name_or_path:
-        tokenizer = AutoTokenizer.from_pretrained(
-            args.model_name_or_path, use_fast=not args.use_slow_tokenizer)
-    else:
-        raise ValueError(
-            "You are instantiating a new tokenizer from scratch. This is not supported by this script."
-            "You can do it from another script, save it, and load it from here, using --tokenizer_name."
-        )
+    tokenizer = load_tokenizer(args)
 
     if args.model_name_or_path:
         logger.info(
@@ -444,40 +1371,54 @@ def main():
 
         # Freeze all transformer weights except of those of the added adapter
         logger.info("Activate ST adapter")
+        model.train_adapter([args.adapter_name])
+        model.set_active_adapters(args.adapter_name)
 
         if args.adapter_drop:
             logger.info(f"Adapter drop activated: Pruning modules from layers with index {[i for i in args.drop_list]}")
-            model = adapter_drop(model, adapters_to_prune=args.drop_list, logger=logger)
-
-        model.train_adapter([args.adapter_name])
-        model.set_active_adapters(args.adapter_name)
+            adapter_drop(model, args.adapter_name, adapters_to_prune=args.drop_list, logger=logger)
 
     if args.tune_all_parameters == True:
         logger.info("Opening normal transformer weights...")
         model.freeze_model(False)  # keep original transformer weights dynamic
 
+    max_seq_length = resolve_max_seq_length(args, tokenizer)
+
     # Preprocessing the datasets.
     # First we tokenize all the texts.
-    column_names = raw_datasets["train"].column_names
-    text_column_name = "text" if "text" in column_names else column_names[0]
-
-    if args.max_seq_length is None:
-        max_seq_length = tokenizer.model_max_length
-        if max_seq_length > 1024:
-            logger.warn(
-                f"The tokenizer picked seems to have a very large `model_max_length` ({tokenizer.model_max_length}). "
-                "Picking 1024 instead. You can change that default value by passing --max_seq_length xxx."
+    if raw_datasets is not None:
+        column_names = raw_datasets["train"].column_names
+        text_column_name = "text" if "text" in column_names else column_names[0]
+
+    # FastMLMCollator looks special tokens up itself
+    return_special_tokens_mask = args.mlm_collator != "fast"
+    if args.token_store_dir is not None:
+        tokenized_datasets = {}
+        digest_cache = StageCache(args.token_store_dir)
+        for split, split_file in (("train", args.train_file), ("validation", args.validation_file)):
+            path = token_store_path(args, split_file, tokenizer, max_seq_length, digest_cache)
+            if not is_token_store(path):
+                raise ValueError(
+                    f"No token store for {split_file} with this tokenizer, max_seq_length and line_by_line in "
+                    f"{args.token_store_dir}, run `run_mlm.py preprocess` with the same arguments first."
+                )
+            logger.info(f"Opening token store {path}")
+            tokenized_datasets[split] = TokenStoreDataset(
+                path, tokenizer, max_seq_length, args.pad_to_max_length, return_special_tokens_mask
             )
-            max_seq_length = 1024
-    else:
-        if args.max_seq_length > tokenizer.model_max_length:
-            logger.warn(
-                f"The max_seq_length passed ({args.max_seq_length}) is larger than the maximum length for the"
-                f"model ({tokenizer.model_max_length}). Using max_seq_length={tokenizer.model_max_length}."
-            )
-        max_seq_length = min(args.max_seq_length, tokenizer.model_max_length)
-
-    if args.line_by_line:
+        digest_cache.flush()
+    elif args.train_token_store is not None:
+        # Token stores hold one line per example, so they are always read line by line.
+        tokenized_datasets = {
+            "train": TokenStoreDataset(
+                args.train_token_store, tokenizer, max_seq_length, args.pad_to_max_length, return_special_tokens_mask
+            ),
+            "validation": TokenStoreDataset(
+                args.validation_token_store, tokenizer, max_seq_length, args.pad_to_max_length,
+                return_special_tokens_mask
+            ),
+        }
+    elif args.line_by_line:
         # When using line_by_line, we just tokenize each nonempty line.
         padding = "max_length" if args.pad_to_max_length else False
 
@@ -559,30 +1500,56 @@ def main():
 
     # Data collator
     # This one will take care of randomly masking the tokens.
-    data_collator = DataCollatorForLanguageModeling(
-        tokenizer=tokenizer, mlm_probability=args.mlm_probability)
+    if args.mlm_collator == "fast":
+        data_collator = FastMLMCollator(tokenizer, mlm_probability=args.mlm_probability)
+    else:
+        data_collator = DataCollatorForLanguageModeling(
+            tokenizer=tokenizer, mlm_probability=args.mlm_probability)
+
+    if args.packing != "none":
+        # RoBERTa style models count positions from after the padding index
+        position_offset = 0
+        if config.model_type in ("roberta", "xlm-roberta", "camembert", "longformer"):
+            position_offset = config.pad_token_id + 1
+        train_dataset = PackedDataset(train_dataset, max_seq_length, args.seed, position_offset)
+        eval_dataset = PackedDataset(eval_dataset, max_seq_length, args.seed, position_offset)
+        logger.info(f"Packed the training lines into {len(train_dataset)} rows, {train_dataset.fill:.1%} full")
+        data_collator = PackedCollator(tokenizer, data_collator, block_diagonal=args.packing == "block_diagonal")
 
     # DataLoaders creation:
-    train_dataloader = DataLoader(
-        train_dataset, shuffle=True, collate_fn=data_collator, batch_size=args.per_device_train_batch_size
-    )
+    # Workers are started anew every epoch, so their seeds come from train_generator, see epoch_generator_seed
+    dataloader_kwargs = {"num_workers": args.dataloader_num_workers, "pin_memory": torch.cuda.is_available()}
+    # Draws the shuffling and the worker seeds of the training data, reseeded every epoch
+    train_generator = torch.Generator()
+    train_collator = SeededCollator(data_collator)
+    train_batch_sampler = None
+    if args.group_by_length:
+        if args.pad_to_max_length:
+            logger.warning("--group_by_length has no effect on padding together with --pad_to_max_length")
+        train_batch_sampler = LengthGroupedBatchSampler(
+            dataset_lengths(train_dataset), args.per_device_train_batch_size, args.length_group_size, args.seed
+        )
+        train_dataloader = DataLoader(
+            train_dataset,
+            batch_sampler=train_batch_sampler,
+            collate_fn=train_collator,
+            generator=train_generator,
+            **dataloader_kwargs,
+        )
+    else:
+        train_dataloader = DataLoader(
+            train_dataset,
+            shuffle=True,
+            collate_fn=train_collator,
+            batch_size=args.per_device_train_batch_size,
+            generator=train_generator,
+            **dataloader_kwargs,
+        )
     eval_dataloader = DataLoader(
-        eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size)
+        eval_dataset, collate_fn=data_collator, batch_size=args.per_device_eval_batch_size, **dataloader_kwargs)
 
     # Optimizer
-    # Split weights in two groups, one with weight decay and the other not.
-    no_decay = ["bias", "LayerNorm.weight"]
-    optimizer_grouped_parameters = [
-        {
-            "params": [p for n, p in model.named_parameters() if not any(nd in n for nd in no_decay)],
-            "weight_decay": args.weight_decay,
-        },
-        {
-            "params": [p for n, p in model.named_parameters() if any(nd in n for nd in no_decay)],
-            "weight_decay": 0.0,
-        },
-    ]
-    optimizer = AdamW(optimizer_grouped_parameters, lr=args.learning_rate)
+    optimizer = build_optimizer(model, args)
 
     # Prepare everything with our `accelerator`.
     model, optimizer, train_dataloader, eval_dataloader = accelerator.prepare(
@@ -628,51 +1595,102 @@ def main():
     progress_bar = tqdm(range(args.max_train_steps),
                         disable=not accelerator.is_local_main_process)
     completed_steps = 0
-
-    for epoch in range(args.num_train_epochs):
+    starting_epoch = 0
+    resume_rng = None
+    if args.resume_from_checkpoint is not None:
+        path = args.resume_from_checkpoint
+        if path == "latest":
+            path = latest_checkpoint(args.output_dir)
+        logger.info(f"Resuming from checkpoint {path}")
+        position, resume_rng = load_checkpoint(path, accelerator, model, optimizer, lr_scheduler)
+        starting_epoch = position["epoch"]
+        completed_steps = position["completed_steps"]
+        progress_bar.update(completed_steps)
+    checkpoint_writer = CheckpointWriter()
+
+    for epoch in range(starting_epoch, args.num_train_epochs):
         model.train()
-        train_loss_sum = 0.0
-        val_loss_sum = 0.0
-        steps = 0
-        for step, batch in enumerate(train_dataloader):
+        if train_batch_sampler is not None:
+            train_batch_sampler.set_epoch(epoch)
+            grouped, ungrouped = train_batch_sampler.padding_report()
+            logger.info(
+                f"epoch {epoch}: padding is {grouped:.1%} of the batched tokens, {ungrouped:.1%} with random batches"
+            )
+        # Detached and on the device, so accumulating the loss keeps no graph alive and never syncs
+        train_loss_sum = torch.zeros((), device=accelerator.device)
+        windows = accumulation_windows(len(train_dataloader), args.gradient_accumulation_steps)
+        # Non-padding tokens trained on, kept on the device so counting them never syncs
+        real_tokens = 0
+        trained_batches = 0
+        skip_batches = 0
+        skip_rng = None
+        train_generator.manual_seed(epoch_generator_seed(args.seed, epoch))
+        train_collator.manual_seed(epoch_collate_seed(args.seed, epoch))
+        if resume_rng is not None:
+            # Draw the same data order, worker seeds and masks as the interrupted epoch, then skip the batches it
+            # trained on
+            train_generator.set_state(resume_rng["epoch_generator"])
+            skip_batches = position["step"] + 1
+            skip_rng, resume_rng = resume_rng, None
+        epoch_generator_state = train_generator.get_state()
+        epoch_start = time.time()
+        for step, batch in skip_trained_batches(train_dataloader, skip_batches, skip_rng):
+            if skip_batches and step == skip_batches:
+                epoch_start = time.time()
+            trained_batches += 1
+            real_tokens += (batch["input_ids"] != tokenizer.pad_token_id).sum()
             # logger.info(tokenizer.batch_decode(sequences=batch["input_ids"]))
-            outputs = model(**batch)
-            loss = outputs.loss
-            loss = loss / args.gradient_accumulation_steps
-            accelerator.backward(loss)
+            sync_gradients, window = windows[step]
+            train_loss_sum += accumulate_batch(accelerator, model, batch, window, sync_gradients, args.mixed_precision)
 
-            
-            if step % args.gradient_accumulation_steps == 0 or step == len(train_dataloader) - 1:
+            if sync_gradients:
                 optimizer.step()
-                lr_scheduler.step()
+                # With fp16 the loss scaler skips steps whose gradients overflowed, the schedule waits for them
+                if not getattr(optimizer, "step_was_skipped", False):
+                    lr_scheduler.step()
                 optimizer.zero_grad()
                 progress_bar.update(1)
                 completed_steps += 1
-                train_loss_sum += loss
-                steps += 1
+                if args.checkpointing_steps is not None and completed_steps % args.checkpointing_steps == 0:
+                    save_checkpoint(
+                        checkpoint_writer,
+                        os.path.join(args.output_dir, f"step_{completed_steps}"),
+                        accelerator,
+                        model,
+                        optimizer,
+                        lr_scheduler,
+                        {"epoch": epoch, "step": step, "completed_steps": completed_steps},
+                        epoch_generator_state,
+                    )
 
             if completed_steps >= args.max_train_steps:
                 break
 
+        tokens_per_second = float(real_tokens) / (time.time() - epoch_start)
+        logger.info(f"epoch {epoch}: {tokens_per_second:.0f} real tokens/sec per process")
+        writer.add_scalar("Throughput/real_tokens_per_sec", tokens_per_second, epoch)
+
         model.eval()
         losses = []
-        for step, batch in enumerate(eval_dataloader):
-            with torch.no_grad():
+        for batch in eval_dataloader:
+            with torch.no_grad(), autocast_context(accelerator, args.mixed_precision):
                 outputs = model(**batch)
 
             loss = outputs.loss
-            val_loss_sum += loss
             losses.append(accelerator.gather(
                 loss.repeat(args.per_device_eval_batch_size)))
 
         losses = torch.cat(losses)
         losses = losses[: len(eval_dataset)]
-        perplexity = math.exp(torch.mean(losses))
-        writer.add_scalar('Loss/train', train_loss_sum/steps, epoch)
-        writer.add_scalar('Loss/val', val_loss_sum/steps, epoch)
+        val_loss = float(torch.mean(losses))
+        perplexity = math.exp(val_loss)
+        writer.add_scalar('Loss/train', float(train_loss_sum) / max(trained_batches, 1), epoch)
+        writer.add_scalar('Loss/val', val_loss, epoch)
 
         logger.info(f"epoch {epoch}: perplexity: {perplexity}")
 
+    complete_checkpoint(checkpoint_writer, accelerator)
+
     if args.output_dir is not None:
         logger.info("Saving model")
         accelerator.wait_for_everyone()